@@ -0,0 +1,447 @@
+# bench.py -- benchmarks for the trainer's hot paths
+#
+# usage: python3 bench.py suite [--size N] [--depth N] [--branching N]
+#        python3 bench.py queue
+#        python3 bench.py import [pgn file]
+#        python3 bench.py memory [--size N] [--depth N] [--branching N]
+#
+# every command takes --output FILE to write its results as JSON, so that
+# runs can be compared across versions
+
+import io
+import os
+import sys
+import argparse
+import contextlib
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import platform
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+try :
+    import resource
+except ImportError :
+    resource = None
+
+import chess
+import chess.pgn
+
+import trainer
+
+#########################
+# synthetic repertoires #
+#########################
+
+# builds a repertoire of about `size' nodes (fewer if the tree runs out of
+# depth), `depth' half moves deep from the starting position: every problem
+# has `branching' replies and every position to solve has a main solution,
+# sometimes with an alternative
+# the training positions get random statuses, and dates spread around today
+def generate_repertoire(size, depth, branching, rng, name = "bench") :
+    board = chess.Board()
+    repertoire = trainer.make_repertoire(board,name,True)
+    today = datetime.date.today()
+    count = 1
+    # breadth first, so that a size limit trims the deepest lines
+    level = [(repertoire, board)]
+    for ply in range(depth) :
+        next_level = []
+        for node, board in level :
+            moves = list(board.legal_moves)
+            rng.shuffle(moves)
+            if (node.player_to_move) :
+                width = 1 + (rng.random() < 0.1)
+            else :
+                width = branching
+            for move in moves[:width] :
+                if (count >= size) :
+                    break
+                child = trainer.attach_move(node,move,board)
+                count += 1
+                if (child.training) :
+                    randomise_training(child.training,today,rng)
+                if (child.transposition == None) :
+                    child_board = board.copy(stack = False)
+                    child_board.push(move)
+                    next_level.append((child, child_board))
+        level = next_level
+    trainer.index_due(repertoire)
+    trainer.update(repertoire)
+    return repertoire
+
+# gives a training position a random status and dates
+def randomise_training(training, today, rng) :
+    training.status = rng.choice([trainer.NEW, trainer.FIRST_STEP, trainer.SECOND_STEP,
+                                  trainer.REVIEW, trainer.REVIEW, trainer.REVIEW, trainer.INACTIVE])
+    gap = rng.randint(1,60)
+    training.last_date = today - datetime.timedelta(days = rng.randint(0,gap))
+    training.due_date = training.last_date + datetime.timedelta(days = gap)
+
+#########
+# suite #
+#########
+
+# times `function' `repeat' times, calling `setup' (untimed) before each run
+# and passing on what it returns
+def measure(function, repeat, setup = None) :
+    runs = []
+    for run in range(repeat) :
+        argument = setup() if setup != None else None
+        start = time.perf_counter()
+        if (setup != None) :
+            function(argument)
+        else :
+            function()
+        runs.append(time.perf_counter() - start)
+    return {"min" : min(runs), "mean" : statistics.mean(runs), "runs" : runs}
+
+# plays a whole training session with scripted answers, the way train does
+# (but without the rendering), and returns the number of cards played
+def simulate_session(repertoire, rng) :
+    queue = trainer.TrainingQueue(trainer.generate_training_queue(repertoire))
+    cards = 0
+    # handle_card_result reports some results on the terminal
+    with contextlib.redirect_stdout(io.StringIO()) :
+        while (not queue.is_empty()) :
+            card = queue.pop()
+            trainer.get_counts(repertoire)
+            result = rng.choice(["OK", "OK", "EASY", "HARD"])
+            trainer.handle_card_result(result,card,queue,repertoire)
+            cards += 1
+    return cards
+
+# times the trainer's hot paths on a synthetic repertoire
+def bench_suite(size, depth, branching, repeat, seed) :
+    results = {}
+    with tempfile.TemporaryDirectory() as directory :
+        trainer.set_rep_path(directory)
+        repertoire = generate_repertoire(size,depth,branching,random.Random(seed))
+        filename = repertoire.meta.name + ".rpt"
+        trainer.save_repertoire(repertoire)
+        trainer.saver.wait()
+        counts = trainer.get_counts(repertoire)
+        info = {
+            "nodes" : len(list(trainer.all_nodes(repertoire))),
+            "training_positions" : trainer.get_total_count(repertoire),
+            "reachable" : counts[6],
+            "waiting" : counts[0] + counts[1] + counts[2] + counts[5],
+            "file_bytes" : os.path.getsize(trainer.rpt_path(repertoire.meta.name)),
+            "state_bytes" : os.path.getsize(trainer.state_path(repertoire.meta.name)),
+        }
+
+        results["open_repertoire"] = measure(lambda : trainer.open_repertoire(filename),repeat)
+        # saving only blocks for the snapshot; the write happens in the background
+        results["save_repertoire"] = measure(lambda previous : trainer.save_repertoire(repertoire),repeat,trainer.saver.wait)
+        results["save_and_write"] = measure(lambda : (trainer.save_repertoire(repertoire), trainer.saver.wait()),repeat)
+        # (after an edit the tree is written too)
+        def edit() :
+            trainer.saver.wait()
+            repertoire.edited = True
+        results["save_edited"] = measure(lambda previous : (trainer.save_repertoire(repertoire), trainer.saver.wait()),repeat,edit)
+        results["update"] = measure(lambda : trainer.update(repertoire),repeat)
+        results["normalise"] = measure(lambda : trainer.normalise(repertoire,repertoire.meta.learn_max),repeat)
+        results["tally"] = measure(lambda : trainer.tally(repertoire),repeat)
+        results["get_counts"] = measure(lambda : trainer.get_counts(repertoire),repeat)
+        results["get_due_nodes"] = measure(lambda : trainer.get_due_nodes(repertoire,datetime.date.today()),repeat)
+        results["get_forecast"] = measure(lambda : trainer.get_forecast(repertoire,30),repeat)
+        def open_to_first_card() :
+            collector = trainer.CardCollector()
+            session = trainer.open_repertoire(filename,[collector])
+            next(trainer.make_cards(session,collector.nodes),None)
+            session.journal.close()
+        results["open_to_first_card"] = measure(open_to_first_card,repeat)
+        results["first_card"] = measure(lambda : next(trainer.generate_training_queue(repertoire),None),repeat)
+        results["generate_training_queue"] = measure(lambda : list(trainer.generate_training_queue(repertoire)),repeat)
+
+        # every session starts from the same saved repertoire, with an empty
+        # journal; the journal writes are part of what a session costs
+        with open(trainer.rpt_path(repertoire.meta.name), "rb") as file :
+            saved = file.read()
+        cards = []
+        def play(session) :
+            # the trainer draws its scheduling jitter from the random module
+            random.seed(seed)
+            cards.append(simulate_session(session,random.Random(seed)))
+            session.journal.close()
+        def reopen() :
+            with open(trainer.rpt_path(repertoire.meta.name), "wb") as file :
+                file.write(saved)
+            if (os.path.exists(trainer.journal_path(repertoire.meta.name))) :
+                os.remove(trainer.journal_path(repertoire.meta.name))
+            return trainer.open_repertoire(filename)
+        results["train_session"] = measure(play,repeat,reopen)
+        results["train_session"]["cards"] = cards
+    return {"repertoire" : info, "timings" : results}
+
+def print_suite_results(results) :
+    info = results["repertoire"]
+    print(f"{info['nodes']} nodes, {info['training_positions']} training positions, {info['file_bytes']} + {info['state_bytes']} bytes")
+    print("")
+    print("operation".ljust(26) + "min ms".ljust(12) + "mean ms")
+    for name, timing in results["timings"].items() :
+        line = name.ljust(26)
+        line += f"{timing['min'] * 1000:.3f}".ljust(12)
+        line += f"{timing['mean'] * 1000:.3f}"
+        print(line)
+
+#########
+# queue #
+#########
+
+# plays a simulated session through a training queue,
+# reinserting cards with the same offsets as handle_card_result
+def run_queue_session(queue, rng) :
+    steps = 0
+    while (not queue.is_empty()) :
+        card = queue.pop()
+        steps += 1
+        # each card is relearned at most twice before it leaves the session
+        if (card[1] < 2) :
+            card[1] += 1
+            if (rng.random() < 0.5) :
+                offset = 1 + int(round(3 * rng.random()))
+            else :
+                offset = 6 + int(round(3 * rng.random()))
+            queue.reinsert(card,offset)
+    return steps
+
+# a plain list with the queue interface, as used before TrainingQueue
+class ListQueue :
+    def __init__(self, cards) :
+        self.cards = list(cards)
+
+    def is_empty(self) :
+        return len(self.cards) == 0
+
+    def pop(self) :
+        return self.cards.pop(0)
+
+    def reinsert(self, card, offset) :
+        self.cards.insert(min(offset, len(self.cards)), card)
+
+# times sessions of increasing size; the cost per card should stay flat
+def bench_queue(sizes) :
+    results = []
+    for size in sizes :
+        row = {"size" : size}
+        for name, queue_class in [("deque", trainer.TrainingQueue), ("list", ListQueue)] :
+            rng = random.Random(size)
+            queue = queue_class([index, 0] for index in range(size))
+            start = time.perf_counter()
+            steps = run_queue_session(queue,rng)
+            elapsed = time.perf_counter() - start
+            row[name] = elapsed / steps * 1e9
+        results.append(row)
+    return results
+
+def print_queue_results(results) :
+    print("cards".ljust(10) + "deque ns/card".ljust(16) + "list ns/card")
+    for row in results :
+        line = str(row["size"]).ljust(10)
+        line += str(int(row["deque"])).ljust(16)
+        line += str(int(row["list"]))
+        print(line)
+
+##########
+# import #
+##########
+
+# writes `games' random games of `plies' half moves to a PGN file, each with
+# a few short variations, starting from a handful of common openings
+def write_synthetic_pgn(path, games, plies, rng) :
+    openings = [["e2e4", "e7e5"], ["e2e4", "c7c5"], ["d2d4", "d7d5"], ["d2d4", "g8f6"], ["c2c4"]]
+    with open(path, "w") as file :
+        for number in range(games) :
+            game = chess.pgn.Game()
+            game.headers["Event"] = f"Synthetic {number + 1}"
+            node = game
+            board = chess.Board()
+            for uci in rng.choice(openings) :
+                move = chess.Move.from_uci(uci)
+                node = node.add_variation(move)
+                board.push(move)
+            while (board.ply() < plies and not board.is_game_over()) :
+                moves = list(board.legal_moves)
+                move = rng.choice(moves)
+                main = node.add_variation(move)
+                # branch off a one move variation now and then
+                if (len(moves) > 1 and rng.random() < 0.1) :
+                    node.add_variation(rng.choice([other for other in moves if other != move]))
+                node = main
+                board.push(move)
+            print(game, file = file, end = "\n\n")
+
+# times a PGN import into an empty repertoire
+def bench_import(path) :
+    repertoire = trainer.make_repertoire(chess.Board(),"bench",True)
+    games, seconds = trainer.import_pgn(repertoire,path)
+    size = os.path.getsize(path)
+    return {
+        "games" : games,
+        "megabytes" : size / 1e6,
+        "seconds" : seconds,
+        "games_per_second" : games / seconds,
+        "positions" : len(repertoire.positions),
+    }
+
+def print_import_results(results) :
+    print(f"{results['games']} games, {results['megabytes']:.1f} MB in {results['seconds']:.2f} s")
+    print(f"{int(results['games_per_second'])} games per second")
+    print(f"{results['positions']} positions in the repertoire")
+
+##########
+# memory #
+##########
+
+# returns the peak resident set size of the process in bytes (None where the
+# platform doesn't report it)
+def peak_rss() :
+    if (resource == None) :
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # (in kilobytes, except on macOS)
+    if (sys.platform == "darwin") :
+        return peak
+    return peak * 1024
+
+# opens a repertoire (in full, or lazily as manage does) and returns the
+# time it takes and the memory: the growth of the peak resident set size, and
+# the bytes allocated by Python once it is open and at the peak of opening it
+# (run in a fresh process, so that nothing else counts)
+def measure_open(directory, filename, lazily = False) :
+    trainer.set_rep_path(directory)
+    opener = trainer.open_lazily if lazily else trainer.open_repertoire
+    # (python-chess is loaded lazily, and shouldn't count)
+    trainer.chess.Board()
+    before = peak_rss()
+    start = time.perf_counter()
+    repertoire = opener(filename)
+    seconds = time.perf_counter() - start
+    repertoire.journal.close()
+    after = peak_rss()
+    del repertoire
+    tracemalloc.start()
+    repertoire = opener(filename)
+    allocated, allocated_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    repertoire.journal.close()
+    return {
+        "seconds" : seconds,
+        "peak_rss_growth" : None if before == None else after - before,
+        "allocated" : allocated,
+        "allocated_peak" : allocated_peak,
+    }
+
+# generates and saves a synthetic repertoire, returning its sizes
+def write_repertoire(directory, size, depth, branching, seed) :
+    trainer.set_rep_path(directory)
+    repertoire = generate_repertoire(size,depth,branching,random.Random(seed))
+    trainer.save_repertoire(repertoire)
+    trainer.saver.wait()
+    return {
+        "nodes" : len(repertoire.nodes),
+        "training_positions" : trainer.get_total_count(repertoire),
+    }
+
+# measures the memory taken by a synthetic repertoire once opened, in full
+# and lazily
+# the repertoire is generated and opened in processes of their own: a new
+# process starts with the peak resident set size of its parent
+def bench_memory(size, depth, branching, seed) :
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    with tempfile.TemporaryDirectory() as directory :
+        with concurrent.futures.ProcessPoolExecutor(max_workers = 1, mp_context = context) as pool :
+            results["repertoire"] = pool.submit(write_repertoire,directory,size,depth,branching,seed).result()
+        for name, lazily in [("memory", False), ("lazy_memory", True)] :
+            with concurrent.futures.ProcessPoolExecutor(max_workers = 1, mp_context = context) as pool :
+                results[name] = pool.submit(measure_open,directory,"bench.rpt",lazily).result()
+    return results
+
+def print_memory_results(results) :
+    info = results["repertoire"]
+    nodes = info["nodes"]
+    print(f"{nodes} nodes, {info['training_positions']} training positions")
+    for title, name in [("Full open", "memory"), ("Lazy open (manage)", "lazy_memory")] :
+        memory = results[name]
+        print("")
+        print(f"{title}: {memory['seconds'] * 1000:.0f} ms")
+        print("measure".ljust(26) + "MiB".ljust(12) + "bytes/node")
+        for measure in ["peak_rss_growth", "allocated", "allocated_peak"] :
+            if (memory[measure] != None) :
+                print(measure.ljust(26) + f"{memory[measure] / 2**20:.1f}".ljust(12) + str(memory[measure] // nodes))
+
+###############
+# entry point #
+###############
+
+# writes results to a JSON file, along with the environment they came from
+def write_results(path, command, parameters, results) :
+    document = {
+        "command" : command,
+        "parameters" : parameters,
+        "date" : datetime.datetime.now().isoformat(timespec = "seconds"),
+        "python" : platform.python_version(),
+        "python_chess" : chess.__version__,
+        "rpt_version" : trainer.rpt_version,
+        "results" : results,
+    }
+    with open(path, "w") as file :
+        json.dump(document,file,indent = 2)
+
+def main() :
+    parser = argparse.ArgumentParser(description = "Opening Trainer benchmarks")
+    parser.add_argument("--output", help = "write the results to this JSON file")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    suite_parser = commands.add_parser("suite", help = "hot paths on a synthetic repertoire")
+    suite_parser.add_argument("--size", type = int, default = 20000, help = "number of nodes")
+    suite_parser.add_argument("--depth", type = int, default = 24, help = "depth in half moves")
+    suite_parser.add_argument("--branching", type = int, default = 3, help = "replies to each problem")
+    suite_parser.add_argument("--repeat", type = int, default = 3)
+    suite_parser.add_argument("--seed", type = int, default = 0)
+    queue_parser = commands.add_parser("queue", help = "training queue micro-benchmark")
+    queue_parser.add_argument("--sizes", type = int, nargs = "+",
+                              default = [1000, 10000, 100000, 300000])
+    import_parser = commands.add_parser("import", help = "PGN import throughput")
+    import_parser.add_argument("pgn", nargs = "?",
+                               help = "PGN file (default: a synthetic file of several megabytes)")
+    import_parser.add_argument("--games", type = int, default = 5000)
+    memory_parser = commands.add_parser("memory", help = "memory taken by an open repertoire")
+    memory_parser.add_argument("--size", type = int, default = 300000, help = "number of nodes (the default gives about 100000 training positions)")
+    memory_parser.add_argument("--depth", type = int, default = 30, help = "depth in half moves")
+    memory_parser.add_argument("--branching", type = int, default = 3, help = "replies to each problem")
+    memory_parser.add_argument("--seed", type = int, default = 0)
+    args = parser.parse_args()
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+
+    if (args.command == "suite") :
+        results = bench_suite(args.size,args.depth,args.branching,args.repeat,args.seed)
+        print_suite_results(results)
+    elif (args.command == "queue") :
+        results = bench_queue(args.sizes)
+        print_queue_results(results)
+    elif (args.command == "import") :
+        if (args.pgn != None) :
+            results = bench_import(args.pgn)
+        else :
+            with tempfile.TemporaryDirectory() as directory :
+                path = os.path.join(directory, "synthetic.pgn")
+                write_synthetic_pgn(path,args.games,80,random.Random(0))
+                results = bench_import(path)
+        print_import_results(results)
+    elif (args.command == "memory") :
+        results = bench_memory(args.size,args.depth,args.branching,args.seed)
+        print_memory_results(results)
+
+    if (args.output != None) :
+        parameters = {name : value for name, value in vars(args).items() if name not in ["command", "output"]}
+        write_results(args.output,args.command,parameters,results)
+
+if (__name__ == "__main__") :
+    main()
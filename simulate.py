@@ -0,0 +1,350 @@
+# simulate.py -- projects the daily training load of a repertoire
+#
+# usage: python3 simulate.py <name> [--days N] [--trajectories N]
+#                            [--learn-max N ...] [--ok-multiplier X ...]
+#                            [--easy-multiplier X ...] [--hard P] [--easy P]
+#
+# Starting from the repertoire's current training data, every trajectory
+# plays one complete session a day and answers each card at random, with the
+# given probabilities of `hard' and `easy' (the rest are `ok'). Giving several
+# values of learn_max or the multipliers runs every combination of them. The
+# repertoire's scheduling options (load balancing and the review cap) are
+# modelled as the trainer applies them.
+#
+# The simulator needs NumPy (pip3 install numpy); the trainer itself doesn't.
+
+import sys
+import argparse
+import datetime
+import itertools
+import json
+import time
+
+try :
+    import numpy
+except ImportError :
+    sys.exit("simulate.py needs NumPy (pip3 install numpy)")
+
+import trainer
+
+# answers, as drawn by the simulator
+HARD = 0
+OK = 1
+EASY = 2
+
+# the due day of a position that hasn't been learned yet
+NEVER = numpy.iinfo(numpy.int32).max
+
+####################
+# repertoire state #
+####################
+
+# PositionCollector - collects the reachable training positions, in the
+# order they are trained
+class PositionCollector(trainer.Visitor) :
+    def __init__(self) :
+        self.nodes = []
+
+    def enter(self, node, reachable) :
+        if (reachable and node.training) :
+            self.nodes.append(node)
+
+# returns the state the simulation starts from: the due days (from today,
+# overdue positions being due today) and gaps of the positions in review,
+# the number of positions still to be learned, and the scheduling options
+def load_state(repertoire) :
+    collector = PositionCollector()
+    trainer.traverse(repertoire,[collector])
+    today = datetime.date.today()
+    due = []
+    gaps = []
+    unlearned = 0
+    for node in collector.nodes :
+        training = node.training
+        if (training.status == trainer.REVIEW) :
+            due.append(max((training.due_date - today).days, 0))
+            gaps.append((training.due_date - training.last_date).days)
+        else :
+            unlearned += 1
+    return {
+        "due" : numpy.array(due, dtype = numpy.int32),
+        "gaps" : numpy.array(gaps, dtype = numpy.int32),
+        "unlearned" : unlearned,
+        "load_balancing" : repertoire.meta.load_balancing,
+        "balance_tolerance" : repertoire.meta.balance_tolerance,
+        "review_cap" : repertoire.meta.review_cap,
+    }
+
+##############
+# simulation #
+##############
+
+# draws `count' answers with the given probabilities of hard, ok and easy
+def draw_answers(rng, count, probabilities) :
+    draws = rng.random(count)
+    return (draws >= probabilities[HARD]).astype(numpy.int8) + (draws >= probabilities[HARD] + probabilities[OK])
+
+# learns `count' positions from the first step, as a session does (a card is
+# put back into the session until it is learned), and returns their first
+# gaps and the number of times each was shown
+def learn(rng, count, probabilities) :
+    gaps = numpy.zeros(count, dtype = numpy.int32)
+    shown = numpy.zeros(count, dtype = numpy.int32)
+    second = numpy.zeros(count, dtype = bool)
+    waiting = numpy.arange(count)
+    while (len(waiting) != 0) :
+        answers = draw_answers(rng, len(waiting), probabilities)
+        shown[waiting] += 1
+        on_second = second[waiting]
+        # first step: easy is learned, ok moves on, hard stays
+        # second step: easy and ok are learned, hard goes back
+        learned = (answers == EASY) | (on_second & (answers == OK))
+        gaps[waiting] = numpy.where(on_second & (answers == EASY), trainer.easy_first_gap, trainer.first_gap)
+        second[waiting] = ~on_second & (answers == OK)
+        waiting = waiting[~learned]
+    return gaps, shown
+
+# returns the rank of each card among the cards of its trajectory, given
+# their trajectories in order
+def ranks_in_rows(rows) :
+    starts = numpy.flatnonzero(numpy.r_[True, rows[1:] != rows[:-1]])
+    counts = numpy.diff(numpy.r_[starts, len(rows)])
+    return numpy.arange(len(rows)) - numpy.repeat(starts, counts)
+
+# Scheduler - the due days given by trainer.schedule, with load balancing or
+# a review cap: the day a position is due on then depends on the recalls
+# already due, so the positions of each trajectory are scheduled one after
+# the other (the trajectories side by side)
+# the recalls due on each day are counted up to a horizon past the simulated
+# days that the windows can reach; the days past it count as empty
+class Scheduler :
+    def __init__(self, state, trajectories, days) :
+        self.tolerance = state["balance_tolerance"] if state["load_balancing"] else 0
+        self.cap = state["review_cap"]
+        self.loads = numpy.zeros((trajectories, 3 * days + 2), dtype = numpy.int32)
+        due = state["due"][state["due"] < self.loads.shape[1]]
+        self.loads += numpy.bincount(due, minlength = self.loads.shape[1]).astype(numpy.int32)
+
+    # checks whether the scheduling options change the due days at all
+    def active(self) :
+        return self.tolerance > 0 or self.cap > 0
+
+    # returns the recalls due on the given days of the given trajectories
+    def load(self, rows, days) :
+        inside = days < self.loads.shape[1]
+        return numpy.where(inside, self.loads[rows, numpy.minimum(days, self.loads.shape[1] - 1)], 0)
+
+    # returns the due days of cards recalled on `day' with the given gaps, and
+    # files them in the loads (rows are the cards' trajectories, in order)
+    def schedule(self, day, rows, gaps) :
+        due = day + gaps
+        if (not self.active()) :
+            return due
+        ranks = ranks_in_rows(rows)
+        for rank in range(ranks.max() + 1) :
+            cards = numpy.flatnonzero(ranks == rank)
+            due[cards] = self.schedule_batch(day, rows[cards], gaps[cards])
+            inside = due[cards] < self.loads.shape[1]
+            self.loads[rows[cards][inside], due[cards][inside]] += 1
+        return due
+
+    # schedules one card of each of the given trajectories
+    def schedule_batch(self, day, rows, gaps) :
+        window = numpy.rint(gaps * self.tolerance).astype(numpy.int32)
+        low = numpy.maximum(1, gaps - window)
+        high = gaps + window
+        # the candidate gaps, as rows of the window (padded past its end)
+        offsets = numpy.arange((high - low).max() + 1)
+        candidates = low[:, None] + offsets
+        valid = candidates <= high[:, None]
+        loads = self.load(rows[:, None], day + candidates)
+        if (self.cap > 0) :
+            valid &= loads < self.cap
+        # the least loaded day, the closest to the gap in a tie, and the
+        # earlier of two as close (as min takes the first)
+        scores = loads.astype(numpy.int64) * (offsets[-1] + 2) + numpy.abs(candidates - gaps[:, None])
+        scores[~valid] = numpy.iinfo(numpy.int64).max
+        best = candidates[numpy.arange(len(rows)), scores.argmin(axis = 1)]
+        # every day in the window is full: the next one which isn't
+        full = numpy.flatnonzero(~valid.any(axis = 1))
+        candidate = high[full] + 1
+        while (len(full) != 0) :
+            free = self.load(rows[full], day + candidate) < self.cap
+            best[full[free]] = candidate[free]
+            full = full[~free]
+            candidate = candidate[~free] + 1
+        return day + best
+
+# keeps at most `cap' of the due recalls of each trajectory, the longest
+# overdue (as trainer.cap_reviews does), given the cards' trajectories in
+# order and their due days
+def cap_reviews(cards, rows, due, cap) :
+    if (cap <= 0) :
+        return cards
+    order = numpy.lexsort((due, rows))
+    kept = order[ranks_in_rows(rows[order]) < cap]
+    return cards[numpy.sort(kept)]
+
+# runs the trajectories, returning the number of reviews and of learning
+# cards shown on each day of each trajectory
+def simulate(state, days, trajectories, learn_max, ok_multiplier, easy_multiplier, probabilities, seed) :
+    rng = numpy.random.default_rng(seed)
+    reviewed = len(state["due"])
+    count = reviewed + state["unlearned"]
+    # one row per trajectory, one column per position (the positions still to
+    # be learned come last, in the order they will be learned)
+    due = numpy.full((trajectories, count), NEVER, dtype = numpy.int32)
+    gaps = numpy.zeros((trajectories, count), dtype = numpy.int32)
+    due[:, :reviewed] = state["due"]
+    gaps[:, :reviewed] = state["gaps"]
+    due_flat = due.reshape(-1)
+    gaps_flat = gaps.reshape(-1)
+    reviews = numpy.zeros((trajectories, days), dtype = numpy.int32)
+    learning = numpy.zeros((trajectories, days), dtype = numpy.int32)
+    next_new = reviewed
+    scheduler = Scheduler(state, trajectories, days)
+
+    for day in range(days) :
+        # new positions (as the session runs to the end, every position
+        # activated in the morning is learned the same day)
+        new = min(learn_max, count - next_new)
+        if (new > 0) :
+            new_gaps, shown = learn(rng, trajectories * new, probabilities)
+            columns = slice(next_new, next_new + new)
+            rows = numpy.repeat(numpy.arange(trajectories), new)
+            due[:, columns] = scheduler.schedule(day, rows, new_gaps).reshape(trajectories, new)
+            # (the next gap grows from the one scheduled)
+            gaps[:, columns] = due[:, columns] - day
+            # (a new card is shown once before its first step)
+            learning[:, day] += shown.reshape(trajectories, new).sum(axis = 1) + new
+            next_new += new
+
+        # recalls (found through flat views of the arrays, which numpy
+        # searches much faster than the rows and columns)
+        cards = numpy.flatnonzero(due_flat <= day)
+        if (len(cards) == 0) :
+            continue
+        # (the rest stay due for the following sessions)
+        cards = cap_reviews(cards, cards // count, due_flat[cards], state["review_cap"])
+        rows = cards // count
+        reviews[:, day] = numpy.bincount(rows, minlength = trajectories)
+        answers = draw_answers(rng, len(cards), probabilities)
+        factors = numpy.where(answers == EASY, easy_multiplier, ok_multiplier) + rng.random(len(cards))
+        new_gaps = numpy.rint(gaps_flat[cards] * factors).astype(numpy.int32)
+        # hard recalls are learned again from the first step
+        hard = numpy.flatnonzero(answers == HARD)
+        if (len(hard) != 0) :
+            relearned_gaps, shown = learn(rng, len(hard), probabilities)
+            new_gaps[hard] = relearned_gaps
+            learning[:, day] += numpy.bincount(rows[hard], weights = shown, minlength = trajectories).astype(numpy.int32)
+        due_flat[cards] = scheduler.schedule(day, rows, new_gaps)
+        gaps_flat[cards] = due_flat[cards] - day
+
+    return reviews, learning
+
+# summarises the daily load (cards shown) over the trajectories
+def summarise(reviews, learning) :
+    load = reviews + learning
+    return {
+        "mean_per_day" : float(load.mean()),
+        "peak_day_mean" : float(load.mean(axis = 0).max()),
+        "peak_day_p90" : float(numpy.percentile(load.max(axis = 1), 90)),
+        "daily_mean" : load.mean(axis = 0).round(2).tolist(),
+        "daily_p10" : numpy.percentile(load, 10, axis = 0).tolist(),
+        "daily_p90" : numpy.percentile(load, 90, axis = 0).tolist(),
+        "reviews_mean" : reviews.mean(axis = 0).round(2).tolist(),
+        "learning_mean" : learning.mean(axis = 0).round(2).tolist(),
+    }
+
+############
+# printing #
+############
+
+def print_sweep(results) :
+    print("LEARN MAX".ljust(11) + "OK".ljust(6) + "EASY".ljust(6) + "MEAN/DAY".ljust(10)
+          + "PEAK DAY".ljust(10) + "PEAK (P90)".ljust(11) + "SECONDS")
+    for result in results :
+        summary = result["summary"]
+        line = str(result["learn_max"]).ljust(11)
+        line += str(result["ok_multiplier"]).ljust(6)
+        line += str(result["easy_multiplier"]).ljust(6)
+        line += f"{summary['mean_per_day']:.1f}".ljust(10)
+        line += f"{summary['peak_day_mean']:.1f}".ljust(10)
+        line += f"{summary['peak_day_p90']:.0f}".ljust(11)
+        line += f"{result['seconds']:.2f}"
+        print(line)
+
+# prints the weekly averages of the daily load of a single run
+def print_weeks(summary) :
+    print("")
+    print("WEEK".ljust(6) + "MEAN".ljust(8) + "P10".ljust(8) + "P90".ljust(8))
+    days = len(summary["daily_mean"])
+    bar_scale = 40 / max(max(summary["daily_mean"]), 1)
+    for start in range(0, days, 7) :
+        week = slice(start, min(start + 7, days))
+        line = str(start // 7 + 1).ljust(6)
+        for series in ["daily_mean", "daily_p10", "daily_p90"] :
+            line += f"{numpy.mean(summary[series][week]):.1f}".ljust(8)
+        bar = "#" * int(round(numpy.mean(summary["daily_mean"][week]) * bar_scale))
+        print(line + bar)
+
+###############
+# entry point #
+###############
+
+def main() :
+    parser = argparse.ArgumentParser(description = "Opening Trainer load simulator")
+    parser.add_argument("name", help = "repertoire name")
+    parser.add_argument("--dir", default = trainer.rep_path, help = "repertoire folder")
+    parser.add_argument("--days", type = int, default = 180)
+    parser.add_argument("--trajectories", type = int, default = 1000)
+    parser.add_argument("--learn-max", type = int, nargs = "+")
+    parser.add_argument("--ok-multiplier", type = float, nargs = "+", default = [trainer.ok_multiplier])
+    parser.add_argument("--easy-multiplier", type = float, nargs = "+", default = [trainer.easy_multiplier])
+    parser.add_argument("--hard", type = float, default = 0.1, help = "probability of a hard answer")
+    parser.add_argument("--easy", type = float, default = 0.2, help = "probability of an easy answer")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--json", action = "store_true", help = "print the results as JSON")
+    args = parser.parse_args()
+    if (args.hard < 0 or args.easy < 0 or args.hard + args.easy > 1) :
+        parser.error("the answer probabilities must lie between 0 and 1")
+    # (learning takes an ok or easy answer)
+    if (args.hard >= 1) :
+        parser.error("the probability of a hard answer must be below 1")
+
+    trainer.set_rep_path(args.dir)
+    repertoire = trainer.open_repertoire(args.name + ".rpt")
+    repertoire.journal.close()
+    state = load_state(repertoire)
+    learn_maxes = args.learn_max or [repertoire.meta.learn_max]
+    probabilities = [args.hard, 1 - args.hard - args.easy, args.easy]
+
+    results = []
+    for learn_max, ok_multiplier, easy_multiplier in itertools.product(learn_maxes, args.ok_multiplier, args.easy_multiplier) :
+        start = time.perf_counter()
+        reviews, learning = simulate(state,args.days,args.trajectories,learn_max,
+                                     ok_multiplier,easy_multiplier,probabilities,args.seed)
+        results.append({
+            "learn_max" : learn_max,
+            "ok_multiplier" : ok_multiplier,
+            "easy_multiplier" : easy_multiplier,
+            "seconds" : time.perf_counter() - start,
+            "summary" : summarise(reviews,learning),
+        })
+
+    if (args.json) :
+        print(json.dumps(results, indent = 2))
+        return
+    print(f"{args.name}: {len(state['due'])} positions in review, {state['unlearned']} to learn")
+    print(f"{args.trajectories} trajectories over {args.days} days")
+    if (state["load_balancing"]) :
+        print(f"load balancing within {int(round(state['balance_tolerance'] * 100))}% of the interval")
+    if (state["review_cap"] > 0) :
+        print(f"at most {state['review_cap']} recalls a day")
+    print("")
+    print_sweep(results)
+    if (len(results) == 1) :
+        print_weeks(results[0]["summary"])
+
+if (__name__ == "__main__") :
+    main()
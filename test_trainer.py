@@ -0,0 +1,503 @@
+# Opening Trainer tests
+# run with `python3 -m unittest test_trainer' (or pytest)
+
+import os
+import pickle
+import random
+import datetime
+import shutil
+import tempfile
+import unittest
+
+import chess
+
+import rep
+import trainer
+
+###########
+# helpers #
+###########
+
+# adds a line of moves (in SAN) from the root of a repertoire, as management
+# does, following transpositions; returns the last node
+def add_line(repertoire,moves) :
+    node = repertoire
+    board = repertoire.board()
+    for san in moves.split() :
+        move = board.parse_san(san)
+        if (not node.has_variation(move)) :
+            trainer.add_move(node,move,board.copy())
+        node = node.variation(move)
+        board.push(move)
+        if (node.transposition != None) :
+            node = node.transposition
+    return node
+
+# promotes a move at the end of a line, as management does
+def promote_line(repertoire,moves,san) :
+    node = repertoire
+    board = repertoire.board()
+    for move in moves.split() :
+        node = node.variation(board.push_san(move))
+    move = board.parse_san(san)
+    trainer.journal_edit(repertoire,trainer.PROMOTE_RECORD,node,move)
+    for changed in trainer.promote_variation(node,move) :
+        trainer.recount(changed)
+    trainer.recount(node)
+
+# returns the node at the end of a line of moves from the root (without
+# following transpositions)
+def find_line(repertoire,moves) :
+    node = repertoire
+    board = repertoire.board()
+    for san in moves.split() :
+        node = node.variation(board.push_san(san))
+    return node
+
+# deletes a move at the end of a line, as management does
+def delete_line(repertoire,moves,san) :
+    node = find_line(repertoire,moves)
+    move = node.board().parse_san(san)
+    trainer.journal_edit(repertoire,trainer.DELETE_RECORD,node,move)
+    for changed in trainer.detach_move(node,move) :
+        trainer.recount(changed)
+    trainer.recount(node)
+
+# records a training result for the position at the end of a line, as a
+# session does
+def train_line(repertoire,moves,status,gap) :
+    node = find_line(repertoire,moves)
+    today = datetime.date.today()
+    node.training.status = status
+    node.training.last_date = today
+    node.training.due_date = today + datetime.timedelta(days=gap)
+    trainer.recount(node)
+    trainer.reindex_due(repertoire,node)
+    trainer.journal_result(repertoire,node)
+
+# the lines of the sample repertoire: transpositions, and an alternative
+# solution (1. e4 c5 2. c3)
+sample_lines = [
+    "e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O",
+    "e4 e5 Nf3 Nf6 Nxe5 d6 Nf3",
+    "e4 c5 Nf3 d6 d4 cxd4 Nxd4",
+    "e4 c5 c3 d5 exd5",
+    "Nf3 Nc6 e4 e5 Bb5",
+    "e4 e5 Bc4 Nf6 d3",
+    "d4 d5 c4 e6 Nc3 Nf6 Bg5",
+    "c4 e6 d4 d5 Nc3",
+]
+
+# makes a repertoire of the sample lines, with training in every status
+def sample_repertoire(name) :
+    repertoire = trainer.make_repertoire(chess.Board(),name,True)
+    for line in sample_lines :
+        add_line(repertoire,line)
+    generator = random.Random(1)
+    today = datetime.date.today()
+    for node in trainer.all_nodes(repertoire) :
+        if (node.training) :
+            node.training.status = generator.choice([trainer.NEW, trainer.FIRST_STEP, trainer.SECOND_STEP, trainer.REVIEW, trainer.REVIEW, trainer.INACTIVE])
+            node.training.last_date = today - datetime.timedelta(days=generator.randint(1,30))
+            node.training.due_date = node.training.last_date + datetime.timedelta(days=generator.randint(1,40))
+    trainer.index_due(repertoire)
+    return repertoire
+
+# returns the line of moves (in UCI) leading to a node
+def path_of(node) :
+    moves = []
+    while (node.parent != None) :
+        moves.append(node.move.uci())
+        node = node.parent
+    return tuple(reversed(moves))
+
+# returns the nodes of a repertoire, in terms that don't depend on how they
+# are numbered: their lines, keys, players to move, links and training
+def snapshot_nodes(repertoire) :
+    nodes = []
+    for node in trainer.all_nodes(repertoire) :
+        training = None
+        if (node.training) :
+            training = (node.training.status, node.training.last_date, node.training.due_date)
+        link = None
+        if (node.transposition != None) :
+            link = path_of(node.transposition)
+        nodes.append((path_of(node), node.key, node.player_to_move, link, training))
+    return nodes
+
+# returns everything a repertoire holds, in terms that don't depend on how
+# its nodes are numbered
+def snapshot(repertoire) :
+    nodes = snapshot_nodes(repertoire)
+    meta = dict(vars(repertoire.meta))
+    positions = sorted((key, path_of(node)) for key, node in repertoire.positions.items())
+    links = sorted((key, sorted(path_of(node) for node in nodes_of)) for key, nodes_of in repertoire.links.items() if len(nodes_of) != 0)
+    due = sorted((node.training.due_date, path_of(node)) for node in repertoire.due.nodes())
+    return nodes, meta, positions, links, due, repertoire.counts, repertoire.total
+
+# returns the solutions (in UCI) of the reachable positions with training
+def reachable_cards(repertoire) :
+    return sorted(node.move.uci() for node in trainer.all_nodes(repertoire) if node.training and trainer.is_reachable(node))
+
+# RepertoireTest - a test with a repertoire folder of its own
+class RepertoireTest(unittest.TestCase) :
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        self.rep_path = trainer.rep_path
+        trainer.set_rep_path(self.folder)
+
+    def tearDown(self) :
+        trainer.saver.wait()
+        trainer.disconnect_database(trainer.database_path())
+        trainer.set_rep_path(self.rep_path)
+        shutil.rmtree(self.folder)
+
+    # makes and saves an empty repertoire, white from the starting position
+    def make(self, name = "test") :
+        repertoire = trainer.make_repertoire(chess.Board(),name,True)
+        trainer.save_repertoire(repertoire)
+        trainer.saver.wait()
+        return repertoire
+
+    # saves the sample repertoire, returning it as saved
+    def make_sample(self, name = "sample") :
+        repertoire = sample_repertoire(name)
+        trainer.save_repertoire(repertoire)
+        trainer.saver.wait()
+        return repertoire
+
+    # opens a repertoire and closes its journal (without saving)
+    def reopen(self, filename = "sample.rpt") :
+        repertoire = trainer.open_repertoire(filename)
+        repertoire.journal.close()
+        return repertoire
+
+###############
+# file format #
+###############
+
+class FileFormatTest(RepertoireTest) :
+    def test_round_trip(self) :
+        repertoire = self.make_sample()
+        self.assertNotEqual(len(repertoire.links), 0)
+        self.assertEqual(snapshot(self.reopen()), snapshot(repertoire))
+
+    def test_encode_decode(self) :
+        repertoire = self.make_sample()
+        tree = trainer.encode_repertoire(repertoire,trainer.encode_columns(repertoire)[0])
+        state = trainer.encode_state(repertoire)
+        decoded = trainer.decode_repertoire(tree,state)
+        trainer.update(decoded)
+        self.assertEqual(snapshot(decoded), snapshot(repertoire))
+        # the state applies by position to a tree that has been edited since
+        find_line(repertoire,"e4 e5 Nf3").remove_variation(chess.Move.from_uci("g8f6"))
+        repertoire = trainer.decode_repertoire(trainer.encode_repertoire(repertoire,trainer.encode_columns(repertoire)[0]),state)
+        trainer.update(repertoire)
+        self.assertEqual(find_line(repertoire,"e4 e5 Nf3 Nc6 Bb5").training.due_date, find_line(decoded,"e4 e5 Nf3 Nc6 Bb5").training.due_date)
+
+    def test_training_only_rewrites_state(self) :
+        self.make_sample()
+        tree = trainer.rpt_path("sample")
+        modified = os.stat(tree).st_mtime_ns
+        repertoire = trainer.open_repertoire("sample.rpt")
+        train_line(repertoire,"e4 e5 Nf3 Nc6 Bb5",trainer.REVIEW,5)
+        trainer.save_repertoire(repertoire)
+        trainer.close_repertoire(repertoire)
+        trainer.saver.wait()
+        self.assertEqual(os.stat(tree).st_mtime_ns, modified)
+        self.assertEqual(snapshot(self.reopen()), snapshot(repertoire))
+
+    def test_legacy_pickle_is_migrated(self) :
+        # a repertoire as pickled by the first versions of the trainer
+        game = chess.pgn.Game()
+        game.meta = rep.MetaData("old", True)
+        game.training = False
+        game.player_to_move = True
+        node = game
+        for san in "e4 e5 Nf3 Nc6 Bb5 a6".split() :
+            child = node.add_variation(node.board().parse_san(san))
+            child.player_to_move = not node.player_to_move
+            child.training = False
+            if (node.player_to_move and node.parent != None) :
+                child.training = rep.TrainingData()
+                child.training.status = trainer.REVIEW
+                child.training.due_date = datetime.date.today() + datetime.timedelta(days=3)
+            node = child
+        with open(trainer.rpt_path("old"), "wb") as file :
+            pickle.dump(game,file)
+        self.assertEqual(trainer.migrate_repertoires(), ["old.rpt"])
+        self.assertEqual(trainer.migrate_repertoires(), [])
+        self.assertTrue(os.path.exists(trainer.rpt_path("old") + ".bak"))
+        with open(trainer.rpt_path("old"), "rb") as file :
+            self.assertEqual(file.read(4), trainer.rpt_magic)
+        repertoire = self.reopen("old.rpt")
+        self.assertEqual(repertoire.meta.review_cap, 0)
+        self.assertEqual(reachable_cards(repertoire), ["f1b5", "g1f3"])
+        self.assertEqual(find_line(repertoire,"e4 e5 Nf3").training.status, trainer.REVIEW)
+        self.assertEqual(find_line(repertoire,"e4 e5 Nf3").training.due_date, datetime.date.today() + datetime.timedelta(days=3))
+
+###########
+# journal #
+###########
+
+class JournalTest(RepertoireTest) :
+    # makes the edits of every kind in the sample repertoire
+    def edit(self, repertoire) :
+        train_line(repertoire,"e4 e5 Nf3 Nc6 Bb5",trainer.REVIEW,7)
+        add_line(repertoire,"e4 e5 Nf3 Nc6 Bb5 Nf6 O-O")
+        add_line(repertoire,"d4 Nf6 c4 e6 Nc3")
+        train_line(repertoire,"d4 Nf6 c4",trainer.FIRST_STEP,0)
+        delete_line(repertoire,"e4 e5 Nf3","Nf6")
+        promote_line(repertoire,"e4 c5","c3")
+        train_line(repertoire,"e4 c5 c3",trainer.REVIEW,2)
+
+    def test_replay(self) :
+        self.make_sample()
+        repertoire = trainer.open_repertoire("sample.rpt")
+        self.edit(repertoire)
+        trainer.update(repertoire)
+        expected = snapshot(repertoire)
+        repertoire.journal.close()
+        self.assertTrue(os.path.exists(trainer.journal_path("sample")))
+        self.assertEqual(snapshot(self.reopen()), expected)
+        # lazily too (a lazy repertoire has the tree, but no training)
+        lazy = trainer.open_lazily("sample.rpt")
+        lazy.journal.close()
+        self.assertEqual([node[:4] for node in snapshot_nodes(lazy)], [node[:4] for node in expected[0]])
+
+    def test_replay_across_generations(self) :
+        self.make_sample()
+        repertoire = trainer.open_repertoire("sample.rpt")
+        self.edit(repertoire)
+        repertoire.journal.close()
+        with open(trainer.journal_path("sample"), "rb") as file :
+            old_journal = file.read()
+        # saving folds the journal into a new generation of the file
+        repertoire = trainer.open_repertoire("sample.rpt")
+        generation = repertoire.generation
+        trainer.save_repertoire(repertoire)
+        trainer.saver.wait()
+        self.assertFalse(os.path.exists(trainer.journal_path("sample")))
+        trainer.update(repertoire)
+        expected = snapshot(repertoire)
+        reopened = self.reopen()
+        self.assertEqual(reopened.generation, generation + 1)
+        self.assertEqual(snapshot(reopened), expected)
+        # a journal of the old generation no longer applies
+        with open(trainer.journal_path("sample"), "wb") as file :
+            file.write(old_journal)
+        self.assertEqual(snapshot(self.reopen()), expected)
+        self.assertFalse(os.path.exists(trainer.journal_path("sample")))
+        # the new generation takes a journal of its own
+        repertoire = trainer.open_repertoire("sample.rpt")
+        delete_line(repertoire,"e4 e5","Bc4")
+        train_line(repertoire,"d4 d5 c4",trainer.REVIEW,4)
+        trainer.update(repertoire)
+        expected = snapshot(repertoire)
+        trainer.close_repertoire(repertoire)
+        self.assertEqual(snapshot(self.reopen()), expected)
+
+    def test_cut_record_ends_journal(self) :
+        self.make_sample()
+        repertoire = trainer.open_repertoire("sample.rpt")
+        train_line(repertoire,"e4 e5 Nf3 Nc6 Bb5",trainer.REVIEW,7)
+        add_line(repertoire,"e4 e5 Nf3 Nc6 Bb5 Nf6 O-O")
+        repertoire.journal.close()
+        # (a crash in the middle of writing the last record)
+        with open(trainer.journal_path("sample"), "r+b") as file :
+            file.truncate(os.path.getsize(trainer.journal_path("sample")) - 2)
+        repertoire = self.reopen()
+        self.assertEqual(find_line(repertoire,"e4 e5 Nf3 Nc6 Bb5").training.due_date, datetime.date.today() + datetime.timedelta(days=7))
+        node = find_line(repertoire,"e4 e5 Nf3 Nc6 Bb5 Nf6")
+        self.assertEqual(node.variations, [])
+
+############
+# database #
+############
+
+class DatabaseTest(RepertoireTest) :
+    def test_round_trip(self) :
+        self.make_sample()
+        files = snapshot(self.reopen())
+        self.assertEqual(trainer.convert_to_database(), ["sample.rpt"])
+        self.assertTrue(trainer.use_database())
+        self.assertEqual(snapshot(self.reopen()), files)
+
+    def test_results_and_edits(self) :
+        self.make_sample()
+        trainer.convert_to_database()
+        repertoire = trainer.open_repertoire("sample.rpt")
+        train_line(repertoire,"e4 e5 Nf3 Nc6 Bb5",trainer.REVIEW,0)
+        # (training results go straight into the rows)
+        self.assertEqual(snapshot(self.reopen())[0], snapshot(repertoire)[0])
+        add_line(repertoire,"e4 e5 Nf3 Nc6 Bb5 Nf6 O-O")
+        promote_line(repertoire,"e4 c5","c3")
+        delete_line(repertoire,"e4 e5","Bc4")
+        trainer.update(repertoire)
+        expected = snapshot(repertoire)
+        trainer.close_repertoire(repertoire)
+        repertoire = self.reopen()
+        self.assertEqual(snapshot(repertoire), expected)
+        # the indexed queries agree with the walks of the tree
+        collector = trainer.CardCollector()
+        trainer.traverse(repertoire,[collector])
+        self.assertEqual(trainer.query_cards(repertoire), collector.nodes)
+        entry = trainer.query_stats_entry("sample")
+        self.assertEqual(entry["counts"], trainer.get_counts(repertoire))
+        self.assertEqual(entry["total"], repertoire.total)
+        board = find_line(repertoire,"e4 e5 Nf3 Nc6").board()
+        self.assertEqual(trainer.find_position(board), [("sample", chess.Move.from_uci("f1b5"), trainer.REVIEW)])
+
+################
+# lazy loading #
+################
+
+class LazyTest(RepertoireTest) :
+    # makes the same random edits in a repertoire opened lazily and in full
+    def test_edits_match_full_tree(self) :
+        self.make_sample()
+        full = trainer.open_repertoire("sample.rpt")
+        full.journal.close()
+        shutil.copytree(self.folder, self.folder + "/lazy")
+        lazy_path = self.folder + "/lazy"
+        trainer.set_rep_path(lazy_path)
+        lazy = trainer.open_lazily("sample.rpt")
+        trainer.set_rep_path(self.folder)
+        full = trainer.open_repertoire("sample.rpt")
+        generator = random.Random(7)
+        for step in range(150) :
+            # a random walk from the root, the same in both
+            node_full = full
+            node_lazy = lazy
+            for depth in range(generator.randint(0,8)) :
+                self.assertEqual([child.move for child in node_full.variations], [child.move for child in node_lazy.variations])
+                if (len(node_full.variations) == 0) :
+                    break
+                index = generator.randrange(len(node_full.variations))
+                node_full = node_full.variations[index]
+                node_lazy = node_lazy.variations[index]
+                if (node_full.transposition != None) :
+                    node_full = node_full.transposition
+                    node_lazy = node_lazy.transposition
+                self.assertEqual(path_of(node_full), path_of(node_lazy))
+            board = node_full.board()
+            choice = generator.random()
+            if (choice < 0.6) :
+                moves = [move for move in board.legal_moves if not node_full.has_variation(move)]
+                if (len(moves) != 0) :
+                    move = generator.choice(moves)
+                    for node in [node_full, node_lazy] :
+                        trainer.add_move(node,move,board.copy())
+            elif (choice < 0.75 and len(node_full.variations) != 0) :
+                move = generator.choice(node_full.variations).move
+                for node in [node_full, node_lazy] :
+                    trainer.journal_edit(node.game(),trainer.DELETE_RECORD,node,move)
+                    for changed in trainer.detach_move(node,move) :
+                        trainer.recount(changed)
+                    trainer.recount(node)
+            elif (len(node_full.variations) > 1) :
+                move = generator.choice(node_full.variations[1:]).move
+                for node in [node_full, node_lazy] :
+                    trainer.journal_edit(node.game(),trainer.PROMOTE_RECORD,node,move)
+                    for changed in trainer.promote_variation(node,move) :
+                        trainer.recount(changed)
+                    trainer.recount(node)
+        full.journal.close()
+        lazy.journal.close()
+        expected = snapshot(self.reopen())
+        trainer.set_rep_path(lazy_path)
+        self.assertEqual(snapshot(self.reopen()), expected)
+
+##################
+# transpositions #
+##################
+
+class TranspositionTest(RepertoireTest) :
+    # the line the repertoire first reached a position in is demoted
+    lines = ["Nf3 Nc6 e4 e5 Bc4 Bc5 d3", "e4 e5 Nf3 Nc6"]
+
+    def test_promote_keeps_continuation_trainable(self) :
+        repertoire = self.make()
+        for line in self.lines :
+            add_line(repertoire,line)
+        self.assertEqual(reachable_cards(repertoire), ["d2d3", "e2e4", "f1c4"])
+        promote_line(repertoire,"","e4")
+        self.assertEqual(reachable_cards(repertoire), ["d2d3", "f1c4", "g1f3"])
+        # the cached counts are those of a fresh count
+        counts = repertoire.counts
+        trainer.tally(repertoire)
+        self.assertEqual(counts, repertoire.counts)
+        self.assertEqual(counts[6], 3)
+
+    def test_promote_replays_from_journal(self) :
+        self.make()
+        repertoire = trainer.open_lazily("test.rpt")
+        for line in self.lines :
+            add_line(repertoire,line)
+        promote_line(repertoire,"","e4")
+        trainer.close_repertoire(repertoire)
+        repertoire = trainer.open_repertoire("test.rpt")
+        self.assertEqual(reachable_cards(repertoire), ["d2d3", "f1c4", "g1f3"])
+        collector = trainer.CardCollector()
+        trainer.traverse(repertoire,[collector])
+        self.assertEqual(sorted(node.move.uci() for node in collector.nodes), ["d2d3", "f1c4", "g1f3"])
+        trainer.save_repertoire(repertoire)
+        trainer.close_repertoire(repertoire)
+        repertoire = trainer.open_repertoire("test.rpt")
+        repertoire.journal.close()
+        self.assertEqual(reachable_cards(repertoire), ["d2d3", "f1c4", "g1f3"])
+
+    def test_delete_keeps_continuation(self) :
+        repertoire = self.make()
+        for line in self.lines :
+            add_line(repertoire,line)
+        trainer.journal_edit(repertoire,trainer.DELETE_RECORD,repertoire,chess.Move.from_uci("g1f3"))
+        for changed in trainer.detach_move(repertoire,chess.Move.from_uci("g1f3")) :
+            trainer.recount(changed)
+        trainer.recount(repertoire)
+        self.assertEqual(reachable_cards(repertoire), ["d2d3", "f1c4", "g1f3"])
+
+###############
+# stats index #
+###############
+
+class StatsIndexTest(RepertoireTest) :
+    def test_entries_round_trip(self) :
+        repertoire = self.make()
+        add_line(repertoire,"e4 e5 Nf3")
+        trainer.save_repertoire(repertoire)
+        trainer.saver.wait()
+        index = trainer.load_stats_index()
+        self.assertEqual(index["test.rpt"]["counts"][6], 1)
+        trainer.save_stats_index(index)
+        self.assertEqual(trainer.load_stats_index(), index)
+        self.assertTrue(trainer.is_valid_stats_entry(index["test.rpt"],"test.rpt"))
+
+    def test_pickled_index_is_ignored(self) :
+        with open(trainer.stats_index_path(), "wb") as file :
+            file.write(b"\x80\x04cos\nsystem\n.")
+        self.assertEqual(trainer.load_stats_index(), {})
+
+##################
+# position index #
+##################
+
+class PositionIndexTest(RepertoireTest) :
+    def test_find_sees_journal(self) :
+        self.make("a")
+        self.make("b")
+        board = chess.Board()
+        for san in "e4 e5 Nf3 Nc6".split() :
+            board.push_san(san)
+        trainer.refresh_position_index()
+        self.assertEqual(trainer.find_position(board), [])
+        # (management's edits stay in the journal)
+        repertoire = trainer.open_lazily("a.rpt")
+        add_line(repertoire,"e4 e5 Nf3 Nc6 Bb5")
+        trainer.close_repertoire(repertoire)
+        self.assertTrue(os.path.exists(trainer.journal_path("a")))
+        trainer.refresh_position_index()
+        self.assertEqual(trainer.find_position(board), [("a", chess.Move.from_uci("f1b5"), trainer.NEW)])
+
+if (__name__ == "__main__") :
+    unittest.main()
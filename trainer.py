@@ -3,14 +3,53 @@
 # c. July 2020
 
 import os
-import chess
-import chess.pgn
+import sys
+import atexit
+import array
+import io
+import importlib
+import builtins
+import argparse
+import functools
+import itertools
+import struct
+import bisect
+import collections
+import gc
+import threading
 import random
 import time
 import pickle
 import datetime
 import time
-import shutil
+import contextlib
+
+# (the indexes are locked across processes where fcntl is available)
+try :
+    import fcntl
+except ImportError :
+    fcntl = None
+
+# LazyModule - a module imported on first use (along with the given
+# submodules), so that commands which don't need it start quickly
+class LazyModule :
+    def __init__(self, name, submodules = []) :
+        self.name = name
+        self.submodules = submodules
+
+    def __getattr__(self, attribute) :
+        module = importlib.import_module(self.name)
+        for submodule in self.submodules :
+            importlib.import_module(self.name + "." + submodule)
+        # from now on the name refers to the module itself
+        globals()[self.name] = module
+        return getattr(module, attribute)
+
+chess = LazyModule("chess", ["pgn", "polyglot"])
+concurrent = LazyModule("concurrent", ["futures"])
+json = LazyModule("json")
+shutil = LazyModule("shutil")
+sqlite3 = LazyModule("sqlite3")
 
 # statuses (every triaing position is in one of these states)
 
@@ -24,11 +63,44 @@ INACTIVE = 4
 
 # TrainingData - data for a given training position
 class TrainingData :
+    __slots__ = ["status", "last_date", "due_date"]
+
     def __init__(self) :
         self.status = INACTIVE
         self.last_date = datetime.date.today()
         self.due_date = datetime.date.today()
 
+    # (old pickled repertoires hold the attributes as a dictionary)
+    def __setstate__(self, state) :
+        for name, value in state.items() :
+            setattr(self, name, value)
+
+# RepertoireNode - a node of a repertoire tree below the root
+# python-chess's ChildNode keeps its attributes in a dictionary per node,
+# along with an empty comment, starting comment and set of NAGs, which make
+# up most of the memory of a large repertoire; a RepertoireNode keeps its
+# attributes in slots instead, and shares the comments and NAGs (which a
+# repertoire never sets) through the class
+# (the class proper, a ChildNode, is made by node_class, as python-chess is
+# loaded lazily)
+class RepertoireNode :
+    slots = ["parent", "move", "variations", "player_to_move", "training", "id",
+             "transposition", "key", "counts", "total"]
+    comment = ""
+    starting_comment = ""
+    nags = frozenset()
+
+    def __init__(self, parent, move) :
+        self.parent = parent
+        self.move = move
+        self.variations = []
+        parent.variations.append(self)
+
+# returns the class of the repertoire nodes (made on first use)
+@functools.lru_cache(maxsize = None)
+def node_class() :
+    return type("RepertoireNode", (RepertoireNode, chess.pgn.ChildNode), {"__slots__" : RepertoireNode.slots})
+
 # MetaData - data for the whole repertoire        
 class  MetaData:
     def __init__(self, name, player) :
@@ -37,6 +109,15 @@ class  MetaData:
         self.learning_data = [datetime.date.today(),0]
         self.learn_max = 10
         self.status = EMPTY
+        self.load_balancing = False
+        self.balance_tolerance = 0.15
+        self.review_cap = 0
+
+# repertoire statuses
+
+EMPTY = 0
+CLEARED = 1
+WANTING = 2
 
 ########
 # misc #
@@ -66,10 +147,99 @@ def is_valid_uci(string, board) :
 # printing #
 ############
 
+# The menus and training screens are drawn with print. In the interactive
+# trainer on a terminal, the output goes to a Screen, which holds each screen
+# until it waits for input and then draws it with a single write: in place,
+# from the top of the terminal, rewriting only the lines that have changed
+# since the last screen.
+
+# Screen - stands in for standard output, composing the screens
+class Screen :
+    def __init__(self, stream) :
+        self.stream = stream
+        self.buffer = io.StringIO()
+        # the lines on the terminal (None where unknown), if known at all
+        self.lines = None
+        self.cleared = False
+
+    def write(self, text) :
+        return self.buffer.write(text)
+
+    def flush(self) :
+        pass
+
+    # starts a new screen
+    def clear(self) :
+        self.buffer = io.StringIO()
+        self.cleared = True
+
+    # draws what has been written since it was last called
+    def present(self) :
+        text = self.buffer.getvalue()
+        self.buffer = io.StringIO()
+        if (not self.cleared) :
+            # more of the same screen, which follows on as printed
+            if (text != "") :
+                self.stream.write(text)
+                self.lines = None
+            self.stream.flush()
+            return
+        self.cleared = False
+        lines = text.split("\n")
+        # (a screen taller than the terminal scrolls, losing track of where
+        # its lines are)
+        tall = len(lines) >= shutil.get_terminal_size().lines
+        if (self.lines == None or tall) :
+            output = ["\x1b[H\x1b[2J", text]
+            if (tall) :
+                lines = None
+        else :
+            output = []
+            for row, line in enumerate(lines) :
+                if (row >= len(self.lines) or self.lines[row] != line) :
+                    output.append(f"\x1b[{row + 1};1H{line}\x1b[K")
+            # leave the cursor at the end of the text, clearing what's below
+            output.append(f"\x1b[{len(lines)};{len(lines[-1]) + 1}H\x1b[J")
+        self.stream.write("".join(output))
+        self.stream.flush()
+        # the answer is typed on the last line
+        if (lines != None) :
+            lines[-1] = None
+        self.lines = lines
+
+# runs the interactive trainer, drawing its output through a Screen if it is
+# on a terminal that understands ANSI escape sequences
+def run_on_screen(function) :
+    if (not sys.stdout.isatty() or os.environ.get("TERM") == "dumb") :
+        function()
+        return
+    # (this turns the escape sequences on in the Windows console)
+    if (os.name == "nt") :
+        os.system("")
+    stream = sys.stdout
+    sys.stdout = Screen(stream)
+    try :
+        function()
+    finally :
+        screen = sys.stdout
+        sys.stdout = stream
+        stream.write(screen.buffer.getvalue())
+        stream.flush()
+
+# waits for a line of input, once the screen is drawn
+def input(prompt="") :
+    if (isinstance(sys.stdout, Screen)) :
+        sys.stdout.write(prompt)
+        sys.stdout.present()
+        prompt = ""
+    return builtins.input(prompt)
+
 # `clears' the screen
 def clear() :
-    for x in range(100) :
-        print("")
+    if (isinstance(sys.stdout, Screen)) :
+        sys.stdout.clear()
+    else :
+        print("\n" * 99)
 
 # prints the side to move
 def print_turn(board) :
@@ -79,19 +249,25 @@ def print_turn(board) :
     else :
         print("BLACK to play.")
 
+# returns the board as a string, from the player's side
+def render_board(board,player) :
+    string = board.unicode(invert_color = True, empty_square = ".")
+    if (not player) :
+        # black's view turns the board around: the ranks and each rank's
+        # squares in reverse
+        string = "\n".join(rank[::-1] for rank in reversed(string.split("\n")))
+    return string
+
 # pretty prints the board
 def print_board(board,player) :
-    string = board.unicode(invert_color = True, empty_square = ".")
-    print("")
-    if (player) :
-        print(string)
-    else :
-        for row in range(8) :
-            row_string = ""        
-            for column in range(15) :
-                row_string += string[(7-row) * 16 + (14 - column)]
-            print(row_string)            
+    print("\n" + render_board(board,player))
                     
+# returns the label of a repertoire move, marking transpositions
+def move_label(node) :
+    if (node.transposition != None) :
+        return node.move.uci() + " (transposition)"
+    return node.move.uci()
+
 # prints repertoire moves for the given node
 def print_moves(node) :
     if (node.player_to_move) :
@@ -100,14 +276,14 @@ def print_moves(node) :
         else :
             print("\nSolutions:")
             for solution in node.variations :
-                print(solution.move.uci())
+                print(move_label(solution))
     else :
         if (node.is_end()) :
             print("\nNo problems.")
         else :
             print("\nProblems:")
             for problem in node.variations :
-                print(problem.move.uci())
+                print(move_label(problem))
 
 ###########################################
 # creating / saving / opening repertoires #
@@ -121,6 +297,28 @@ def rpt_path(name) :
 def rpt_name(filename) :
     return filename[:-4]
 
+# returns the path to a repertoire's journal given its name
+def journal_path(name) :
+    return rep_path + "/" + name + ".jnl"
+
+# returns the path to a repertoire's training state given its name
+def state_path(name) :
+    return rep_path + "/" + name + ".trn"
+
+# checks whether there is a repertoire of the given name
+def repertoire_exists(name) :
+    if (use_database()) :
+        return is_stored(name)
+    return os.path.exists(rpt_path(name))
+
+# returns the repertoire filenames in the data directory, in alphabetical order
+# (once any new ones have been written)
+def list_repertoires() :
+    saver.wait()
+    if (use_database()) :
+        return sorted(list_stored_repertoires())
+    return sorted(name for name in os.listdir(rep_path) if name.endswith(".rpt"))
+
 # permanently deletes a repertoire
 def delete_repertoire(filenames) :
     # TODO: the prompting should go in the calling function
@@ -130,25 +328,190 @@ def delete_repertoire(filenames) :
         print (f"you are about to permanently delete `{filenames[index]}'.")
         check = input("are you sure:")
         if (check == "y") :
+            saver.wait()
+            if (use_database()) :
+                delete_stored(rpt_name(filenames[index]))
+                return
             os.remove(rep_path + "/" + filenames[index])
-
-# saves a repertoire (by pickling)            
+            for path in [journal_path(rpt_name(filenames[index])), state_path(rpt_name(filenames[index]))] :
+                if (os.path.exists(path)) :
+                    os.remove(path)
+            store_position_entries({filenames[index] : None})
+
+# Saver - writes repertoire files on a background thread, so that the menus
+# stay responsive while a large file goes to disk
+# a save is queued as a snapshot of the files' contents; a newer save of the
+# same repertoire replaces one still waiting, and anything reading or
+# appending to the files waits for the writes first
+class Saver :
+    def __init__(self) :
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.writing = None
+        self.error = None
+        self.thread = None
+
+    # queues the contents of a repertoire's files, as pairs of path and data
+    # written in order, along with its stats index entry and its position
+    # index entries (which are seen to once the files are in place)
+    def submit(self, name, files, entry, positions) :
+        with self.condition :
+            # a save still waiting for the same repertoire is merged in: each
+            # file takes the newest data, but a file only the waiting save
+            # writes (its tree, say) is written all the same
+            if (name in self.pending) :
+                merged = dict(self.pending[name][0])
+                merged.update(files)
+                files = list(merged.items())
+            self.pending[name] = (files, entry, positions)
+            # (a pool worker inherits the saver, but not its thread)
+            if (self.thread == None or not self.thread.is_alive()) :
+                self.thread = threading.Thread(target = self.run, name = "saver", daemon = True)
+                self.thread.start()
+                atexit.register(self.wait)
+            self.condition.notify_all()
+
+    # waits until all queued saves have been written
+    def wait(self) :
+        with self.condition :
+            while (len(self.pending) != 0 or self.writing != None) :
+                self.condition.wait()
+            error = self.error
+            self.error = None
+        if (error != None) :
+            raise error
+
+    def run(self) :
+        while (True) :
+            with self.condition :
+                while (len(self.pending) == 0) :
+                    self.condition.wait()
+                name = next(iter(self.pending))
+                files, entry, positions = self.pending.pop(name)
+                self.writing = name
+            try :
+                for path, data in files :
+                    write_file(path,data)
+                # the journal has been folded into the files, so it can go
+                # once they are safely in place
+                if (os.path.exists(journal_path(name))) :
+                    os.remove(journal_path(name))
+                store_stats_entry(name + ".rpt",entry)
+                store_position_entries({name + ".rpt" : positions})
+            except Exception as error :
+                self.error = error
+            with self.condition :
+                self.writing = None
+                self.condition.notify_all()
+
+# the saver for this process
+saver = Saver()
+
+# writes a file safely: to a temporary file, which is flushed to disk and then
+# swapped in, so that an interrupted write leaves the old file whole
+def write_file(path,data) :
+    with open(path + ".tmp", "wb") as file :
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+    # make the rename itself durable (directories can't be opened on Windows)
+    if (hasattr(os, "O_DIRECTORY")) :
+        directory = os.open(os.path.dirname(path) or ".", os.O_RDONLY | os.O_DIRECTORY)
+        try :
+            os.fsync(directory)
+        finally :
+            os.close(directory)
+
+# saves a repertoire (in the columnar format below), folding in its journal:
+# its training state always, and its tree only if it has been edited
+# the files are written in the background (see Saver)
 def save_repertoire (repertoire) :
-    filename = rpt_path(repertoire.meta.name)
+    name = repertoire.meta.name
     update(repertoire)
-    with open(filename, "wb") as file :
-        pickle.dump(repertoire,file)
-
-# opens a repertoire (i.e. restores the Python objects by unpickling)        
-def open_repertoire (filename) :
+    if (use_database()) :
+        repertoire.generation += 1
+        # (written at once, in a transaction)
+        store_repertoire(repertoire)
+        if (repertoire.journal != None) :
+            repertoire.journal.restart(repertoire.generation)
+        return
+    tree = None
+    if (repertoire.edited) :
+        # the new tree starts a new journal generation, as its nodes are
+        # renumbered
+        repertoire.generation += 1
+        tree = encode_repertoire(repertoire,encode_columns(repertoire)[0])
+        repertoire.edited = False
+    # the state goes first: should the tree not follow, the journal still
+    # applies to the old tree
+    files = [(state_path(name), encode_state(repertoire))]
+    if (tree != None) :
+        files.append((rpt_path(name), tree))
+    if (repertoire.journal != None) :
+        repertoire.journal.restart(repertoire.generation)
+    entry = make_stats_entry(name + ".rpt",repertoire)
+    saver.submit(name,files,entry,make_position_entries(repertoire))
+
+# opens a repertoire (i.e. restores the Python objects from the file, then
+# replays its journal); repertoires still in the old pickled format are
+# migrated on the way
+# the given visitors join the walk of the tree made by update
+def open_repertoire (filename,visitors=[]) :
+    saver.wait()
+    if (use_database()) :
+        repertoire, stale = load_repertoire(rpt_name(filename))
+        changed = update(repertoire,visitors)
+        repertoire.journal = DatabaseJournal(repertoire)
+        # the node rows are kept exact for the queries
+        if (stale or changed) :
+            save_repertoire(repertoire)
+        return repertoire
     filepath = rep_path + "/" + filename
     with open(filepath, "rb") as file :
-        repertoire = pickle.load(file)
-    update(repertoire)
+        data = file.read()
+    if (data[:4] == rpt_magic) :
+        try :
+            with open(state_path(rpt_name(filename)), "rb") as file :
+                state = file.read()
+        except FileNotFoundError :
+            state = None
+        repertoire = decode_repertoire(data,state)
+        replay_journal(repertoire,journal_path(rpt_name(filename)))
+    else :
+        repertoire = migrate_repertoire(filepath,data)
+    update(repertoire,visitors)
+    repertoire.journal = Journal(journal_path(rpt_name(filename)),repertoire.generation)
     return repertoire
 
+# closes a repertoire after a training or management session
+# the journal is folded into the file once it has grown large
+def close_repertoire (repertoire) :
+    repertoire.journal.close()
+    # (a lazy repertoire can't be saved: its journal is folded in the next
+    # time the repertoire is opened in full)
+    if (repertoire.lazy) :
+        return
+    if (use_database()) :
+        # edits are folded in at once, so that the node rows stay exact
+        if (repertoire.journal.size() != 0) :
+            save_repertoire(repertoire)
+        return
+    # (folding in training results only rewrites the state, which files in
+    # the older formats keep in the tree)
+    base_path = state_path(repertoire.meta.name)
+    if (not os.path.exists(base_path)) :
+        base_path = rpt_path(repertoire.meta.name)
+    base_size = os.path.getsize(base_path)
+    if (repertoire.journal.size() > max(base_size // 4, journal_min_size)) :
+        save_repertoire(repertoire)
+    else :
+        refresh_stats_entry(repertoire)
+
 # updates a repertoire's scheduling data 
-def update(repertoire) :
+# (the given visitors join normalise's walk of the tree)
+# returns whether any status changed
+def update(repertoire,visitors=[]) :
     learning_date = repertoire.meta.learning_data[0]
     learning_value = repertoire.meta.learning_data[1]
     max_value = repertoire.meta.learn_max
@@ -158,10 +521,1456 @@ def update(repertoire) :
     if (learning_date < today) :
         repertoire.meta.learning_data[0] = today
         repertoire.meta.learning_data[1] = 0
-        normalise(repertoire,max_value)
+        return normalise(repertoire,max_value,visitors)
     else :
         learning_threshold = max_value - learning_value
-        normalise(repertoire,learning_threshold)
+        return normalise(repertoire,learning_threshold,visitors)
+
+##########################
+# repertoire file format #
+##########################
+
+# A repertoire file holds a small header, the metadata (as JSON), the FEN of
+# the starting position and then one column per node attribute. The nodes are
+# stored in preorder, with the root first, so that every parent precedes its
+# children and the variations keep their order. All integers are little-endian.
+#
+# header      magic, version, (reserved), metadata length, FEN length, node count
+# parents     int32   index of the parent node (-1 for the root)
+# ends        int32   index just past the node's subtree
+# links       int32   index of the node a transposition links to (-1 if none)
+# last dates  int32   last training date as a day ordinal (0 if no training)
+# due dates   int32   due date as a day ordinal (0 if no training)
+# keys        uint64  Zobrist hash of the position
+# moves       uint16  from square | to square << 6 | promotion << 12
+# flags       uint8   1 if the player is to move, 2 if the node has training
+# statuses    uint8   training status
+#
+# The ends column lets a node's children be found without reading the rest of
+# its subtree (see lazy loading); files before version 5 don't have it.
+# Files from version 4 on hold only the tree: the training columns (dates
+# and statuses) are kept in the repertoire's state file (below), so that a
+# training session doesn't rewrite the tree. Version 3 files end with the due
+# index: the number of review positions (uint32), then their node indices
+# (int32) in order of due date. Version 1 files have no links or keys
+# columns.
+#
+# The state file (Repertoires/<name>.trn) holds the training data of the
+# positions with training, in preorder, keyed by position rather than by
+# node, so that it still applies after the tree has been edited:
+#
+# header      magic, version, (reserved), learning date, learning value,
+#             position count, review count
+# keys        uint64  Zobrist hash of the position
+# last dates  int32
+# due dates   int32
+# statuses    uint8
+# reviews     int32   indices (in the state) of the review positions, in
+#                     order of due date
+#
+# Positions of the tree missing from the state are new (inactive); where a
+# position has training in several nodes (only in trees from before
+# transpositions were recognised), their entries are matched in order.
+
+rpt_magic = b"OTRP"
+rpt_version = 5
+rpt_header = struct.Struct("<4sHHIII")
+state_magic = b"OTRT"
+state_version = 1
+state_header = struct.Struct("<4sHHiiII")
+state_columns = ["keys", "last_dates", "due_dates", "statuses"]
+
+# the columns stored by each version, in file order
+rpt_columns = {
+    1 : ["parents", "last_dates", "due_dates", "moves", "flags", "statuses"],
+    2 : ["parents", "links", "last_dates", "due_dates", "keys", "moves", "flags", "statuses"],
+    3 : ["parents", "links", "last_dates", "due_dates", "keys", "moves", "flags", "statuses"],
+    4 : ["parents", "links", "keys", "moves", "flags"],
+    5 : ["parents", "ends", "links", "keys", "moves", "flags"],
+}
+review_count = struct.Struct("<I")
+column_types = {
+    "parents" : "i",
+    "ends" : "i",
+    "links" : "i",
+    "last_dates" : "i",
+    "due_dates" : "i",
+    "keys" : "Q",
+    "moves" : "H",
+    "flags" : "B",
+    "statuses" : "B",
+}
+
+PLAYER_FLAG = 1
+TRAINING_FLAG = 2
+
+# packs a move into 16 bits
+def encode_move(move) :
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+# unpacks a move from 16 bits
+def decode_move(value) :
+    return chess.Move(value & 63, value >> 6 & 63, value >> 12 or None)
+
+# converts an array between native and little-endian byte order
+def swap_to_little(column) :
+    if (sys.byteorder == "big") :
+        column.byteswap()
+    return column
+
+# serialises the tree of a repertoire to bytes, given its columns
+def encode_repertoire(repertoire,columns) :
+    meta_bytes = encode_meta(repertoire).encode()
+    fen_bytes = repertoire.board().fen().encode()
+    header = rpt_header.pack(rpt_magic,rpt_version,0,len(meta_bytes),len(fen_bytes),len(columns["parents"]))
+    chunks = [header, meta_bytes, fen_bytes]
+    for name in rpt_columns[rpt_version] :
+        chunks.append(swap_to_little(array.array(column_types[name], columns[name])).tobytes())
+    return b"".join(chunks)
+
+# serialises the training state of a repertoire to bytes
+# (from repertoire.trained, the nodes with training in preorder, as of the
+# tree's last encoding or decoding: the tree itself isn't walked)
+def encode_state(repertoire) :
+    trained = repertoire.trained
+    entries = {}
+    for entry, node in enumerate(trained) :
+        entries[node.id] = entry
+    reviews = array.array("i", [entries[node.id] for node in repertoire.due.nodes()])
+    learning_date, learning_value = repertoire.meta.learning_data
+    header = state_header.pack(state_magic,state_version,0,learning_date.toordinal(),learning_value,len(trained),len(reviews))
+    chunks = [header]
+    chunks.append(array.array("Q", [node.key for node in trained]))
+    chunks.append(array.array("i", [node.training.last_date.toordinal() for node in trained]))
+    chunks.append(array.array("i", [node.training.due_date.toordinal() for node in trained]))
+    chunks.append(array.array("B", [node.training.status for node in trained]))
+    chunks.append(reviews)
+    for index in range(1, len(chunks)) :
+        chunks[index] = swap_to_little(chunks[index]).tobytes()
+    return b"".join(chunks)
+
+# returns the metadata of a repertoire as JSON
+def encode_meta(repertoire) :
+    meta = repertoire.meta
+    return json.dumps({
+        "name" : meta.name,
+        "player" : meta.player,
+        "learning_date" : meta.learning_data[0].toordinal(),
+        "learning_value" : meta.learning_data[1],
+        "learn_max" : meta.learn_max,
+        "status" : meta.status,
+        "load_balancing" : meta.load_balancing,
+        "balance_tolerance" : meta.balance_tolerance,
+        "review_cap" : meta.review_cap,
+        "generation" : repertoire.generation,
+    })
+
+# returns the columns of a repertoire (as arrays) and the indices of its
+# review positions in order of due date
+def encode_columns(repertoire) :
+    columns = {}
+    for name in column_types :
+        columns[name] = array.array(column_types[name])
+    parents = columns["parents"]
+    links = columns["links"]
+    last_dates = columns["last_dates"]
+    due_dates = columns["due_dates"]
+    keys = columns["keys"]
+    moves = columns["moves"]
+    flags = columns["flags"]
+    statuses = columns["statuses"]
+
+    # preorder walk, visiting the variations in order
+    # (the nodes are renumbered to match their positions in the file)
+    nodes = []
+    stack = [(repertoire,-1)]
+    while (len(stack) != 0) :
+        node, parent = stack.pop()
+        index = len(parents)
+        node.id = index
+        nodes.append(node)
+        parents.append(parent)
+        keys.append(node.key)
+        if (parent == -1) :
+            moves.append(0)
+        else :
+            moves.append(encode_move(node.move))
+        flag = 0
+        if (node.player_to_move) :
+            flag |= PLAYER_FLAG
+        if (node.training) :
+            flag |= TRAINING_FLAG
+            statuses.append(node.training.status)
+            last_dates.append(node.training.last_date.toordinal())
+            due_dates.append(node.training.due_date.toordinal())
+        else :
+            statuses.append(0)
+            last_dates.append(0)
+            due_dates.append(0)
+        flags.append(flag)
+        for child in reversed(node.variations) :
+            stack.append((child,index))
+    repertoire.nodes = nodes
+
+    # links are written once every node has its index
+    for node in nodes :
+        if (node.transposition != None) :
+            links.append(node.transposition.id)
+        else :
+            links.append(-1)
+
+    columns["ends"] = subtree_ends(parents)
+    reviews = array.array("i", (node.id for node in repertoire.due.nodes()))
+    repertoire.trained = [node for node in nodes if node.training]
+    return columns, reviews
+
+# returns the ends column of a tree, given its parents column
+def subtree_ends(parents) :
+    ends = array.array("i", range(1, len(parents) + 1))
+    # (a node's subtree ends where that of its last descendant does)
+    for index in range(len(parents) - 1, 0, -1) :
+        parent = parents[index]
+        if (ends[index] > ends[parent]) :
+            ends[parent] = ends[index]
+    return ends
+
+# reads the tree columns of a repertoire file, returning its version,
+# metadata, starting position, columns and the offset of whatever follows
+def decode_columns(data) :
+    magic, version, reserved, meta_length, fen_length, count = rpt_header.unpack_from(data)
+    if (magic != rpt_magic or version not in rpt_columns) :
+        raise ValueError(f"unsupported repertoire file (version {version})")
+
+    # read the columns straight out of the buffer
+    offset = rpt_header.size
+    meta_data = json.loads(data[offset:offset + meta_length])
+    offset += meta_length
+    fen = data[offset:offset + fen_length].decode()
+    offset += fen_length
+    columns = {}
+    for name in rpt_columns[version] :
+        column = array.array(column_types[name])
+        size = column.itemsize * count
+        column.frombytes(data[offset:offset + size])
+        columns[name] = swap_to_little(column)
+        offset += size
+    return version, meta_data, fen, columns, offset
+
+# restores a repertoire from bytes (those of its tree, then those of its
+# training state, if any, for files in the current format)
+def decode_repertoire(data,state=None) :
+    version, meta_data, fen, columns, offset = decode_columns(data)
+    reviews = None
+    if (version == 3) :
+        (total,) = review_count.unpack_from(data,offset)
+        offset += review_count.size
+        reviews = array.array("i")
+        reviews.frombytes(data[offset:offset + reviews.itemsize * total])
+        swap_to_little(reviews)
+    if (version >= 4) :
+        reviews = decode_state(state,columns,meta_data)
+    repertoire = without_collection(build_repertoire,meta_data,fen,columns,reviews)
+    # (a file in an older format is saved whole in the current one)
+    repertoire.edited = repertoire.edited or version < rpt_version
+    return repertoire
+
+# fills in the training columns of a tree from its training state, returning
+# the node indices of the review positions in order of due date
+# (the learning data of the state goes into the metadata)
+def decode_state(data,columns,meta_data) :
+    flags = columns["flags"]
+    keys = columns["keys"]
+    count = len(flags)
+    trained = [index for index in range(count) if flags[index] & TRAINING_FLAG]
+    # positions without state are new
+    today = datetime.date.today().toordinal()
+    last_dates = columns["last_dates"] = array.array("i", [0]) * count
+    due_dates = columns["due_dates"] = array.array("i", [0]) * count
+    statuses = columns["statuses"] = array.array("B", [0]) * count
+    for index in trained :
+        last_dates[index] = due_dates[index] = today
+        statuses[index] = INACTIVE
+    if (data == None) :
+        return []
+
+    magic, version, reserved, learning_date, learning_value, total, reviewed = state_header.unpack_from(data)
+    if (magic != state_magic or version != state_version) :
+        raise ValueError(f"unsupported training state (version {version})")
+    meta_data["learning_date"] = learning_date
+    meta_data["learning_value"] = learning_value
+    offset = state_header.size
+    state = {}
+    for name in state_columns :
+        column = array.array(column_types[name])
+        size = column.itemsize * total
+        column.frombytes(data[offset:offset + size])
+        state[name] = swap_to_little(column)
+        offset += size
+    reviews = array.array("i")
+    reviews.frombytes(data[offset:offset + reviews.itemsize * reviewed])
+    swap_to_little(reviews)
+
+    # match the entries to the nodes: one to one if the tree is the one the
+    # state was saved with, and otherwise by position
+    nodes = [-1] * total
+    if (total == len(trained) and state["keys"] == array.array("Q", [keys[index] for index in trained])) :
+        nodes = trained
+    else :
+        entries = {}
+        for entry in reversed(range(total)) :
+            entries.setdefault(state["keys"][entry],[]).append(entry)
+        for index in trained :
+            matches = entries.get(keys[index])
+            if (matches) :
+                nodes[matches.pop()] = index
+    for entry in range(total) :
+        index = nodes[entry]
+        if (index != -1) :
+            last_dates[index] = state["last_dates"][entry]
+            due_dates[index] = state["due_dates"][entry]
+            statuses[index] = state["statuses"][entry]
+    return [nodes[entry] for entry in reviews if nodes[entry] != -1]
+
+# calls a function with the cyclic garbage collector paused
+# building a tree makes a great many objects, none of them garbage, which
+# would otherwise set off collections that walk the growing tree again and
+# again
+def without_collection(function,*arguments) :
+    collecting = gc.isenabled()
+    gc.disable()
+    try :
+        return function(*arguments)
+    finally :
+        if (collecting) :
+            gc.enable()
+
+# rebuilds the metadata of a repertoire from its JSON
+def decode_meta(meta_data) :
+    meta = MetaData(meta_data["name"],meta_data["player"])
+    meta.learning_data = [datetime.date.fromordinal(meta_data["learning_date"]),meta_data["learning_value"]]
+    meta.learn_max = meta_data["learn_max"]
+    meta.status = meta_data["status"]
+    # (scheduling options, which older files don't have)
+    meta.load_balancing = meta_data.get("load_balancing",False)
+    meta.balance_tolerance = meta_data.get("balance_tolerance",0.15)
+    meta.review_cap = meta_data.get("review_cap",0)
+    return meta
+
+# rebuilds a repertoire from its metadata, starting position and columns
+# (reviews lists the review positions in order of due date, if known)
+def build_repertoire(meta_data,fen,columns,reviews) :
+    count = len(columns["parents"])
+    parents = columns["parents"]
+    last_dates = columns["last_dates"]
+    due_dates = columns["due_dates"]
+    moves = columns["moves"]
+    flags = columns["flags"]
+    statuses = columns["statuses"]
+    meta = decode_meta(meta_data)
+
+    # rebuild the tree (moves and dates are immutable, so they are shared)
+    move_cache = {}
+    date_cache = {}
+    nodes = []
+    node_type = node_class()
+    for index in range(count) :
+        if (parents[index] == -1) :
+            node = chess.pgn.Game()
+            node.setup(fen)
+            node.meta = meta
+            node.generation = meta_data.get("generation",0)
+            node.edited = False
+            node.lazy = False
+            node.nodes = nodes
+            node.journal = None
+            node.position_cache = PositionCache()
+        else :
+            value = moves[index]
+            move = move_cache.get(value)
+            if (move == None) :
+                move = move_cache[value] = decode_move(value)
+            node = node_type(nodes[parents[index]],move)
+        node.player_to_move = bool(flags[index] & PLAYER_FLAG)
+        if (flags[index] & TRAINING_FLAG) :
+            training = TrainingData.__new__(TrainingData)
+            training.status = statuses[index]
+            for attribute, ordinal in [("last_date", last_dates[index]), ("due_date", due_dates[index])] :
+                date = date_cache.get(ordinal)
+                if (date == None) :
+                    date = date_cache[ordinal] = datetime.date.fromordinal(ordinal)
+                setattr(training,attribute,date)
+            node.training = training
+        else :
+            node.training = False
+        node.id = index
+        node.transposition = None
+        nodes.append(node)
+
+    # restore the position keys and transposition links, indexing the
+    # positions on the way (in preorder, as index_positions does)
+    if ("keys" in columns) :
+        keys = columns["keys"]
+        links = columns["links"]
+        positions = {}
+        position_links = {}
+        for index, node in enumerate(nodes) :
+            key = node.key = keys[index]
+            if (links[index] != -1) :
+                node.transposition = nodes[links[index]]
+                position_links.setdefault(key,[]).append(node)
+                # (links were saved without training before they had cards)
+                if (not node.training and is_card(node)) :
+                    node.training = TrainingData()
+                    nodes[0].edited = True
+            elif (key not in positions) :
+                positions[key] = node
+        nodes[0].positions = positions
+        nodes[0].links = position_links
+    else :
+        compute_keys(nodes[0])
+        index_positions(nodes[0])
+    if (reviews != None) :
+        nodes[0].due = DueIndex()
+        for index in reviews :
+            nodes[0].due.add(nodes[index])
+    else :
+        index_due(nodes[0])
+    nodes[0].trained = [node for node in nodes if node.training]
+    return nodes[0]
+
+# unpickles repertoires saved before the columnar format, which may refer to
+# the classes under other module names, and to python-chess's old GameNode
+class LegacyUnpickler(pickle.Unpickler) :
+    def find_class(self, module, name) :
+        if (name in ["TrainingData", "MetaData"] and module in ["__main__", "rep", "trainer"]) :
+            return globals()[name]
+        if (module == "chess.pgn" and name == "GameNode") :
+            return chess.pgn.ChildNode
+        return super().find_class(module,name)
+
+# converts a pickled repertoire to the columnar format (keeping a backup of
+# the original file) and returns the updated repertoire
+def migrate_repertoire(filepath,data) :
+    repertoire = LegacyUnpickler(io.BytesIO(data)).load()
+    repertoire.generation = 0
+    repertoire.edited = True
+    repertoire.lazy = False
+    repertoire.journal = None
+    repertoire.position_cache = PositionCache()
+    # (pickled metadata predates the scheduling options)
+    defaults = MetaData(repertoire.meta.name,repertoire.meta.player)
+    for option in ["load_balancing","balance_tolerance","review_cap"] :
+        if (not hasattr(repertoire.meta,option)) :
+            setattr(repertoire.meta,option,getattr(defaults,option))
+    compute_keys(repertoire)
+    index_due(repertoire)
+    shutil.copyfile(filepath,filepath + ".bak")
+    save_repertoire(repertoire)
+    # (a pool worker may exit as soon as it returns)
+    saver.wait()
+    index_positions(repertoire)
+    return repertoire
+
+# migrates all pickled repertoires in the data directory, returning the
+# filenames of those migrated
+def migrate_repertoires() :
+    filenames = map_repertoires(migrate_file,list_repertoires())
+    return [filename for filename in filenames if filename != None]
+
+###########
+# journal #
+###########
+
+# Every training result and management edit is appended to the repertoire's
+# journal (Repertoires/<name>.jnl) as it happens, so that nothing is lost if
+# a session is interrupted, and saving costs O(1) per action. Opening a
+# repertoire replays the journal over the file, and close_repertoire folds it
+# into the file once it has grown large.
+#
+# Nodes are identified by their index in the file (node.id), with new nodes
+# numbered on from there in the order they are added. The journal starts with
+# the generation of the file it applies to; a journal left over from an older
+# file is ignored.
+
+journal_magic = b"OTRJ"
+journal_header = struct.Struct("<4sI")
+journal_min_size = 64 * 1024
+
+# record kinds
+RESULT_RECORD = 1
+ADD_RECORD = 2
+DELETE_RECORD = 3
+PROMOTE_RECORD = 4
+
+# kind, node id, status, last date, due date, learning date, learning value
+result_record = struct.Struct("<BIBiiii")
+# kind, parent node id, move
+edit_record = struct.Struct("<BIH")
+
+# Journal - the append-only log of an open repertoire
+class Journal :
+    def __init__(self, path, generation) :
+        self.path = path
+        self.generation = generation
+        self.file = None
+
+    # appends a record, making sure it reaches the disk
+    def append(self, record) :
+        if (self.file == None) :
+            # a save in progress removes the journal of the old file
+            saver.wait()
+            exists = os.path.exists(self.path)
+            self.file = open(self.path, "ab")
+            if (not exists) :
+                self.file.write(journal_header.pack(journal_magic,self.generation))
+        self.file.write(record)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # returns the size of the journal in bytes
+    def size(self) :
+        try :
+            return os.path.getsize(self.path)
+        except OSError :
+            return 0
+
+    # starts again after the journal has been folded into a new file
+    def restart(self, generation) :
+        self.close()
+        self.generation = generation
+
+    def close(self) :
+        if (self.file != None) :
+            self.file.close()
+            self.file = None
+
+# appends a record to the repertoire's journal (unless it is being replayed)
+def journal_append(repertoire,record) :
+    if (repertoire.journal != None) :
+        repertoire.journal.append(record)
+
+# records the training data of a node after a card result
+def journal_result(repertoire,node) :
+    training = node.training
+    learning_date, learning_value = repertoire.meta.learning_data
+    journal_append(repertoire, result_record.pack(RESULT_RECORD, node.id, training.status,
+        training.last_date.toordinal(), training.due_date.toordinal(),
+        learning_date.toordinal(), learning_value))
+
+# records a management edit of the given kind
+def journal_edit(repertoire,kind,node,move) :
+    repertoire.edited = True
+    journal_append(repertoire, edit_record.pack(kind, node.id, encode_move(move)))
+
+# applies the records in a journal to a freshly decoded repertoire
+# (the cached counts are left for update to build)
+def replay_journal(repertoire,path) :
+    try :
+        with open(path, "rb") as file :
+            data = file.read()
+    except OSError :
+        return
+    # a journal left over from an older file must not be appended to
+    if (len(data) < journal_header.size) :
+        os.remove(path)
+        return
+    magic, generation = journal_header.unpack_from(data)
+    if (magic != journal_magic or generation != repertoire.generation) :
+        os.remove(path)
+        return
+
+    offset = journal_header.size
+    while (offset < len(data)) :
+        if (data[offset] == RESULT_RECORD) :
+            size = result_record.size
+        else :
+            size = edit_record.size
+        # a record cut short by a crash ends the journal
+        if (offset + size > len(data)) :
+            break
+        if (not replay_record(repertoire,data[offset:offset + size])) :
+            break
+        offset += size
+
+# applies a journal record to a repertoire, returning False if the record
+# doesn't fit it
+def replay_record(repertoire,record) :
+    nodes = repertoire.nodes
+    kind = record[0]
+    if (kind == RESULT_RECORD) :
+        fields = result_record.unpack(record)
+    else :
+        fields = edit_record.unpack(record)
+    if (fields[1] >= len(nodes)) :
+        return False
+    # (a lazy repertoire has no training data)
+    if (kind == RESULT_RECORD and repertoire.lazy) :
+        return True
+    node = nodes[fields[1]]
+    if (kind == RESULT_RECORD) :
+        node.training.status = fields[2]
+        node.training.last_date = datetime.date.fromordinal(fields[3])
+        node.training.due_date = datetime.date.fromordinal(fields[4])
+        repertoire.meta.learning_data = [datetime.date.fromordinal(fields[5]),fields[6]]
+        reindex_due(repertoire,node)
+    else :
+        move = decode_move(fields[2])
+        repertoire.edited = True
+        if (kind == ADD_RECORD) :
+            attach_move(node,move)
+        elif (kind == DELETE_RECORD) :
+            detach_move(node,move)
+        elif (kind == PROMOTE_RECORD) :
+            promote_variation(node,move)
+        else :
+            return False
+    return True
+
+################
+# lazy loading #
+################
+
+# Management visits a few lines of a repertoire at a time, so manage opens a
+# repertoire lazily: only the columns of its file are read, and each node is
+# made when it is first reached -- the children of a node when its variations
+# are first asked for, the position a link leads to when it is first followed.
+# The time and memory it takes grow with what is visited, not with the size
+# of the repertoire.
+#
+# The position index, the links and the node list of a lazy repertoire are
+# views of the columns (see LazyPositions, LazyLinks and LazyNodes), so the
+# edits (attach_move, detach_move and promote_variation) work on it
+# unchanged. They go to the journal as usual, but a lazy repertoire is never
+# saved, nor has it any training data: its journal is folded in the next time
+# the repertoire is opened in full, which takes care of the untouched
+# subtrees for free.
+
+# LazyNode - a node of a lazy repertoire, whose variations and transposition
+# are made on first use (mixed into the repertoire nodes by lazy_node_class)
+class LazyNode :
+    def __getattr__(self, name) :
+        if (name == "variations") :
+            self.variations = self.tree.expand(self)
+            return self.variations
+        if (name == "transposition") :
+            self.transposition = self.tree.node(self.tree.links[self.id])
+            return self.transposition
+        raise AttributeError(name)
+
+# returns the class of the nodes of lazy repertoires (made on first use)
+@functools.lru_cache(maxsize = None)
+def lazy_node_class() :
+    return type("LazyRepertoireNode", (LazyNode, node_class()), {"__slots__" : ["tree"]})
+
+# LazyTree - the columns of a repertoire file, and the nodes made from them
+# so far (by index)
+class LazyTree :
+    def __init__(self, columns, root) :
+        self.parents = columns["parents"]
+        self.ends = columns["ends"]
+        self.links = columns["links"]
+        self.keys = columns["keys"]
+        self.moves = columns["moves"]
+        self.flags = columns["flags"]
+        self.made = {0 : root}
+        self.move_cache = {}
+        self.node_type = lazy_node_class()
+        self.first = None
+        self.linked = None
+
+    # yields the indices of a node's children, in order
+    def children(self, index) :
+        child = index + 1
+        while (child < self.ends[index]) :
+            yield child
+            child = self.ends[child]
+
+    # makes the children of a node (without their variations)
+    def expand(self, node) :
+        children = []
+        for index in self.children(node.id) :
+            child = self.node_type.__new__(self.node_type)
+            child.tree = self
+            child.parent = node
+            value = self.moves[index]
+            move = self.move_cache.get(value)
+            if (move == None) :
+                move = self.move_cache[value] = decode_move(value)
+            child.move = move
+            child.player_to_move = bool(self.flags[index] & PLAYER_FLAG)
+            child.training = False
+            child.id = index
+            child.key = self.keys[index]
+            if (self.links[index] == -1) :
+                child.transposition = None
+            child.counts = own_counts[0]
+            child.total = 0
+            self.made[index] = child
+            children.append(child)
+        return children
+
+    # returns the node of an index, making it (and its ancestors) if need be
+    def node(self, index) :
+        node = self.made.get(index)
+        if (node == None) :
+            # (making the parent's variations makes the node)
+            self.node(self.parents[index]).variations
+            node = self.made[index]
+        return node
+
+    # indexes the keys column: the first node of each position and the links
+    # to each (made on the first lookup, so that browsing doesn't wait for it)
+    def index_keys(self) :
+        count = len(self.keys)
+        self.first = dict(zip(reversed(self.keys), range(count - 1, -1, -1)))
+        self.linked = {}
+        for index, link in enumerate(self.links) :
+            if (link != -1) :
+                self.linked.setdefault(self.keys[index],[]).append(index)
+
+    # returns the index of the first node of a position in the file, other
+    # than links (or -1)
+    def position(self, key) :
+        if (self.first == None) :
+            self.index_keys()
+        index = self.first.get(key, -1)
+        # (a link may come first, if the tree was saved after a hand over)
+        while (index != -1 and self.links[index] != -1) :
+            following = index + 1
+            index = -1
+            for later in range(following, len(self.keys)) :
+                if (self.keys[later] == key) :
+                    index = later
+                    break
+        return index
+
+    # returns the indices of the links to a position in the file
+    def links_to(self, key) :
+        if (self.linked == None) :
+            self.index_keys()
+        return self.linked.get(key, [])
+
+# LazyNodes - the node list of a lazy repertoire (repertoire.nodes): the
+# nodes of the file, made on demand, then those added since
+class LazyNodes :
+    def __init__(self, tree) :
+        self.tree = tree
+        self.count = len(tree.parents)
+        self.added = []
+
+    def __len__(self) :
+        return self.count + len(self.added)
+
+    def __getitem__(self, index) :
+        if (index < self.count) :
+            return self.tree.node(index)
+        return self.added[index - self.count]
+
+    def append(self, node) :
+        self.added.append(node)
+
+# LazyPositions - the position index of a lazy repertoire
+# (repertoire.positions): the first node of each position in the file, other
+# than links, unless the position has been indexed afresh since
+class LazyPositions :
+    def __init__(self, tree) :
+        self.tree = tree
+        self.changed = {}
+
+    def get(self, key, default = None) :
+        if (key in self.changed) :
+            node = self.changed[key]
+        else :
+            index = self.tree.position(key)
+            node = None if index == -1 else self.tree.node(index)
+        if (node == None) :
+            return default
+        return node
+
+    def __getitem__(self, key) :
+        node = self.get(key)
+        if (node == None) :
+            raise KeyError(key)
+        return node
+
+    def __setitem__(self, key, node) :
+        self.changed[key] = node
+
+    def __delitem__(self, key) :
+        self.changed[key] = None
+
+    def __contains__(self, key) :
+        return self.get(key) != None
+
+# LazyLinks - the links of a lazy repertoire (repertoire.links): the links to
+# each position, listed from the file the first time they're asked for
+class LazyLinks :
+    def __init__(self, tree) :
+        self.tree = tree
+        self.lists = {}
+
+    # returns the (changeable) list of the links to a position
+    def lookup(self, key) :
+        links = self.lists.get(key)
+        if (links == None) :
+            links = self.lists[key] = [self.tree.node(index) for index in self.tree.links_to(key)]
+        return links
+
+    def get(self, key, default = None) :
+        links = self.lookup(key)
+        if (len(links) == 0) :
+            return default
+        return links
+
+    def __getitem__(self, key) :
+        links = self.lookup(key)
+        if (len(links) == 0) :
+            raise KeyError(key)
+        return links
+
+    def __delitem__(self, key) :
+        self.lists[key] = []
+
+    def __contains__(self, key) :
+        return len(self.lookup(key)) != 0
+
+    def setdefault(self, key, default = None) :
+        return self.lookup(key)
+
+# opens a repertoire for management: lazily if it's in a file with position
+# keys (version 2 on), and otherwise in full
+def open_lazily(filename) :
+    saver.wait()
+    if (use_database()) :
+        return open_repertoire(filename)
+    with open(rep_path + "/" + filename, "rb") as file :
+        data = file.read()
+    if (data[:4] != rpt_magic or rpt_header.unpack_from(data)[1] < 2) :
+        return open_repertoire(filename)
+    version, meta_data, fen, columns, offset = decode_columns(data)
+    if (version < 5) :
+        columns["ends"] = subtree_ends(columns["parents"])
+
+    repertoire = chess.pgn.Game()
+    repertoire.setup(fen)
+    repertoire.meta = decode_meta(meta_data)
+    repertoire.generation = meta_data.get("generation",0)
+    repertoire.edited = False
+    repertoire.lazy = True
+    repertoire.journal = None
+    repertoire.position_cache = PositionCache()
+    repertoire.player_to_move = bool(columns["flags"][0] & PLAYER_FLAG)
+    repertoire.training = False
+    repertoire.id = 0
+    repertoire.key = columns["keys"][0]
+    repertoire.transposition = None
+    repertoire.counts = own_counts[0]
+    repertoire.total = 0
+    tree = LazyTree(columns,repertoire)
+    repertoire.variations = tree.expand(repertoire)
+    repertoire.nodes = LazyNodes(tree)
+    repertoire.positions = LazyPositions(tree)
+    repertoire.links = LazyLinks(tree)
+    repertoire.due = DueIndex()
+    replay_journal(repertoire,journal_path(rpt_name(filename)))
+    # (the nodes added by the journal have no cached counts yet; a node's
+    # children are added after it)
+    for node in reversed(repertoire.nodes.added) :
+        set_counts(node)
+    repertoire.journal = Journal(journal_path(rpt_name(filename)),repertoire.generation)
+    return repertoire
+
+############
+# database #
+############
+
+# A repertoire folder can keep its repertoires in a SQLite database
+# (Repertoires/repertoires.db) instead of one file each: once the database
+# exists, every repertoire in the folder lives there (`trainer.py convert'
+# copies the files in). The menus don't see the difference, as the
+# repertoires keep their filenames (name.rpt) as keys.
+#
+# The database holds a row per node, with the same columns as the file format
+# (the training columns being NULL for nodes without training) plus a flag
+# for the nodes reachable in training, so that the main menu's counts are
+# queries answered from the indexes rather than walks of the trees. Training
+# results update the rows of their nodes as they happen, each in a
+# transaction of its own, and management edits are logged (as journal
+# records) until the repertoire is closed and written back whole.
+
+database_name = "repertoires.db"
+
+database_schema = [
+    """CREATE TABLE IF NOT EXISTS repertoires (
+        name TEXT PRIMARY KEY,
+        meta TEXT NOT NULL,
+        fen TEXT NOT NULL,
+        normalised INTEGER NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS nodes (
+        repertoire TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        parent INTEGER NOT NULL,
+        link INTEGER NOT NULL,
+        last_date INTEGER,
+        due_date INTEGER,
+        key INTEGER NOT NULL,
+        move INTEGER NOT NULL,
+        flags INTEGER NOT NULL,
+        status INTEGER,
+        reachable INTEGER NOT NULL,
+        PRIMARY KEY (repertoire, id)) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS nodes_status ON nodes (repertoire, status, reachable)",
+    "CREATE INDEX IF NOT EXISTS nodes_due ON nodes (repertoire, due_date, status, reachable)",
+    # (for the position lookup: positions by key, and their main solutions)
+    "CREATE INDEX IF NOT EXISTS nodes_key ON nodes (key)",
+    "CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (repertoire, parent, id)",
+    """CREATE TABLE IF NOT EXISTS edits (
+        repertoire TEXT NOT NULL,
+        record BLOB NOT NULL)""",
+]
+
+# the node columns, in table order
+node_columns = ["parents", "links", "last_dates", "due_dates", "keys", "moves", "flags", "statuses"]
+
+# open connections, by database path (and process, as pool workers mustn't
+# share their parent's)
+connections = {}
+
+# returns the path to the database of the repertoire folder
+def database_path() :
+    return rep_path + "/" + database_name
+
+# checks whether the repertoire folder keeps its repertoires in a database
+def use_database() :
+    return os.path.exists(database_path())
+
+# returns a connection to a repertoire database, creating it if need be
+def connect_database(path=None) :
+    if (path == None) :
+        path = database_path()
+    connection = connections.get((path, os.getpid()))
+    if (connection == None) :
+        connection = sqlite3.connect(path)
+        with connection :
+            for statement in database_schema :
+                connection.execute(statement)
+        connections[(path, os.getpid())] = connection
+    return connection
+
+# closes a connection to a repertoire database
+def disconnect_database(path) :
+    connection = connections.pop((path, os.getpid()), None)
+    if (connection != None) :
+        connection.close()
+
+# SQLite integers are signed, so the 64 bit keys are stored as such
+def key_to_integer(key) :
+    if (key >= 1 << 63) :
+        return key - (1 << 64)
+    return key
+
+def integer_to_key(value) :
+    return value & 0xFFFFFFFFFFFFFFFF
+
+# returns the names of the repertoires in the database (as filenames)
+def list_stored_repertoires() :
+    rows = connect_database().execute("SELECT name FROM repertoires")
+    return [name + ".rpt" for (name,) in rows]
+
+# checks whether the database holds a repertoire of the given name
+def is_stored(name) :
+    row = connect_database().execute("SELECT 1 FROM repertoires WHERE name = ?", (name,)).fetchone()
+    return row != None
+
+# writes a repertoire to the database whole, in place of any earlier copy
+# and its logged edits
+def store_repertoire(repertoire,connection=None) :
+    if (connection == None) :
+        connection = connect_database()
+    name = repertoire.meta.name
+    columns, reviews = encode_columns(repertoire)
+    # a node is reachable if its parent is, unless the parent is a player
+    # node and the node isn't its main solution
+    reachable = []
+    for node in repertoire.nodes :
+        if (node.parent == None) :
+            reachable.append(1)
+        elif (node.parent.player_to_move and node.parent.variations[0] is not node) :
+            reachable.append(0)
+        else :
+            reachable.append(reachable[node.parent.id])
+    rows = []
+    for index, node in enumerate(repertoire.nodes) :
+        # (the row holds the name and id, then the columns in table order)
+        row = [name, index]
+        for column in node_columns :
+            row.append(columns[column][index])
+        row[6] = key_to_integer(row[6])
+        if (not node.training) :
+            row[4] = row[5] = row[9] = None
+        row.append(reachable[index])
+        rows.append(row)
+    with connection :
+        connection.execute("DELETE FROM nodes WHERE repertoire = ?", (name,))
+        connection.execute("DELETE FROM edits WHERE repertoire = ?", (name,))
+        connection.execute("INSERT OR REPLACE INTO repertoires VALUES (?, ?, ?, ?)",
+                           (name, encode_meta(repertoire), repertoire.board().fen(), datetime.date.today().toordinal()))
+        connection.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+# restores a repertoire from the database, replaying its logged edits
+# (returns the repertoire, and whether it must be written back: it has edits,
+# or its statuses were last brought up to date on another day)
+def load_repertoire(name) :
+    connection = connect_database()
+    row = connection.execute("SELECT meta, fen, normalised FROM repertoires WHERE name = ?", (name,)).fetchone()
+    if (row == None) :
+        raise FileNotFoundError(f"no repertoire `{name}' in {database_path()}")
+    meta, fen, normalised = row
+    query = "SELECT parent, link, last_date, due_date, key, move, flags, status FROM nodes WHERE repertoire = ? ORDER BY id"
+    values = zip(*connection.execute(query, (name,)))
+    columns = {}
+    for column, value in zip(node_columns, values) :
+        if (column == "keys") :
+            value = map(integer_to_key, value)
+        elif (column in ["last_dates", "due_dates", "statuses"]) :
+            value = [field or 0 for field in value]
+        columns[column] = array.array(column_types[column], value)
+    query = "SELECT id FROM nodes WHERE repertoire = ? AND status = ? ORDER BY due_date, id"
+    reviews = [id for (id,) in connection.execute(query, (name, REVIEW))]
+    repertoire = without_collection(build_repertoire,json.loads(meta),fen,columns,reviews)
+
+    edits = connection.execute("SELECT record FROM edits WHERE repertoire = ? ORDER BY rowid", (name,)).fetchall()
+    for (record,) in edits :
+        if (not replay_record(repertoire,record)) :
+            break
+    stale = repertoire.edited or len(edits) != 0 or normalised != datetime.date.today().toordinal()
+    return repertoire, stale
+
+# deletes a repertoire from the database
+def delete_stored(name) :
+    connection = connect_database()
+    with connection :
+        for table, column in [("repertoires", "name"), ("nodes", "repertoire"), ("edits", "repertoire")] :
+            connection.execute(f"DELETE FROM {table} WHERE {column} = ?", (name,))
+
+# DatabaseJournal - the journal of a repertoire kept in the database, which
+# writes training results straight into the node rows and logs the edits
+class DatabaseJournal :
+    def __init__(self, repertoire) :
+        self.repertoire = repertoire
+        self.generation = repertoire.generation
+
+    def append(self, record) :
+        name = self.repertoire.meta.name
+        connection = connect_database()
+        with connection :
+            if (record[0] == RESULT_RECORD) :
+                fields = result_record.unpack(record)
+                connection.execute("UPDATE nodes SET status = ?, last_date = ?, due_date = ? WHERE repertoire = ? AND id = ?",
+                                   (fields[2], fields[3], fields[4], name, fields[1]))
+                connection.execute("UPDATE repertoires SET meta = ? WHERE name = ?", (encode_meta(self.repertoire), name))
+            else :
+                connection.execute("INSERT INTO edits VALUES (?, ?)", (name, record))
+
+    # returns the number of logged edits
+    def size(self) :
+        query = "SELECT count(*) FROM edits WHERE repertoire = ?"
+        return connect_database().execute(query, (self.repertoire.meta.name,)).fetchone()[0]
+
+    def restart(self, generation) :
+        self.generation = generation
+
+    def close(self) :
+        pass
+
+# returns a stats index entry for a repertoire in the database, counted by
+# queries on its node rows (or None if the rows may be out of date: they are
+# brought up to date when it's next opened)
+def query_stats_entry(name) :
+    connection = connect_database()
+    row = connection.execute("SELECT normalised FROM repertoires WHERE name = ?", (name,)).fetchone()
+    if (row == None) :
+        return None
+    today = datetime.date.today().toordinal()
+    counts = [0,0,0,0,0,0,0]
+    query = "SELECT status, count(*) FROM nodes WHERE repertoire = ? AND status IS NOT NULL AND reachable GROUP BY status"
+    for status, count in connection.execute(query, (name,)) :
+        counts[status] = count
+        counts[6] += count
+    # a new day activates inactive positions
+    if (row[0] != today and counts[INACTIVE] != 0) :
+        return None
+    query = "SELECT count(*) FROM nodes WHERE repertoire = ? AND due_date <= ? AND status = ? AND reachable"
+    counts[5] = connection.execute(query, (name, today, REVIEW)).fetchone()[0]
+    query = "SELECT due_date FROM nodes WHERE repertoire = ? AND due_date IS NOT NULL AND status = ? AND reachable ORDER BY due_date LIMIT 1"
+    row = connection.execute(query, (name, REVIEW)).fetchone()
+    next_due = None
+    if (row != None) :
+        next_due = datetime.date.fromordinal(row[0])
+    query = "SELECT count(*) FROM nodes WHERE repertoire = ? AND status IS NOT NULL"
+    total = connection.execute(query, (name,)).fetchone()[0]
+    return {
+        "date" : datetime.date.today(),
+        "name" : name,
+        "counts" : counts,
+        "total" : total,
+        "next_due" : next_due,
+    }
+
+# returns the nodes waiting to be trained in an open repertoire in the
+# database, as CardCollector collects them, from the indexes (opening the
+# repertoire brings its node rows up to date, and numbers its nodes as the
+# rows)
+def query_cards(repertoire) :
+    query = """SELECT id FROM nodes WHERE repertoire = ? AND reachable
+               AND (status IN (?, ?, ?) OR (status = ? AND due_date <= ?))
+               ORDER BY id"""
+    today = datetime.date.today().toordinal()
+    rows = connect_database().execute(query, (repertoire.meta.name, NEW, FIRST_STEP, SECOND_STEP, REVIEW, today))
+    return [repertoire.nodes[id] for (id,) in rows]
+
+# returns the repertoires in the database which hold a position, as
+# find_position does (the main solution being the first child in order)
+def query_position(key) :
+    query = """SELECT position.repertoire, solution.move, solution.status
+               FROM nodes AS position JOIN nodes AS solution
+               ON solution.repertoire = position.repertoire
+               AND solution.id = (SELECT min(id) FROM nodes WHERE repertoire = position.repertoire AND parent = position.id)
+               WHERE position.key = ? AND position.flags & ? AND position.reachable
+               ORDER BY position.repertoire"""
+    rows = connect_database().execute(query, (key_to_integer(key), PLAYER_FLAG))
+    return [(name, decode_move(move), status) for name, move, status in rows]
+
+# copies the repertoire files of the folder into a new database
+# (the files are left as they are, and the folder goes back to them if the
+# database is removed)
+def convert_to_database() :
+    filenames = list_repertoires()
+    path = database_path()
+    temporary = path + ".tmp"
+    if (os.path.exists(temporary)) :
+        os.remove(temporary)
+    connection = connect_database(temporary)
+    for filename in filenames :
+        repertoire = open_repertoire(filename)
+        repertoire.journal.close()
+        store_repertoire(repertoire,connection)
+    disconnect_database(temporary)
+    # (pickled repertoires are migrated on the way)
+    saver.wait()
+    # the folder switches over with the database
+    os.replace(temporary, path)
+    return filenames
+
+##################
+# transpositions #
+##################
+
+# Every position in a repertoire is indexed by its Zobrist hash (node.key) in
+# repertoire.positions. When a move leads to a position that is already in the
+# repertoire, the new node becomes a link to the existing one (its
+# transposition) instead of a copy. A link has no variations of its own, so a
+# position and its continuation are stored, counted and trained once, in the
+# line where it was first entered. A card is a position and its solution,
+# though, so a solution that transposes keeps training data of its own.
+# repertoire.links lists the links to each position.
+#
+# The walks of the tree (traverse, the reachable flags of the database, the
+# position index) don't follow links, so the edits keep the node of every
+# position reachable in training whenever one of its links is (see settle).
+
+# checks whether a node is a card, i.e. the solution to a position (the
+# first move of the repertoire aside)
+def is_card(node) :
+    return node.parent != None and node.parent.parent != None and not node.player_to_move
+
+# returns the key of a position
+def position_key(board) :
+    return chess.polyglot.zobrist_hash(board)
+
+# yields every node of a subtree, in preorder
+def all_nodes(node) :
+    stack = [node]
+    while (len(stack) != 0) :
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.variations))
+
+# sets the position keys of a tree saved without them (it has no links)
+def compute_keys(node,board=None) :
+    if (board == None) :
+        board = node.board()
+    node.key = position_key(board)
+    node.transposition = None
+    for child in node.variations :
+        board.push(child.move)
+        compute_keys(child,board)
+        board.pop()
+
+# builds the position index of a repertoire
+def index_positions(repertoire) :
+    repertoire.positions = {}
+    repertoire.links = {}
+    for node in all_nodes(repertoire) :
+        if (node.transposition != None) :
+            repertoire.links.setdefault(node.key,[]).append(node)
+        elif (node.key not in repertoire.positions) :
+            repertoire.positions[node.key] = node
+
+# removes a link from the position index
+def unlink(repertoire,link) :
+    links = repertoire.links[link.key]
+    links.remove(link)
+    if (len(links) == 0) :
+        del repertoire.links[link.key]
+
+# makes a link the indexed node of its position in place of `gone', which is
+# leaving the tree, and moves gone's continuation over to it
+def hand_over(repertoire,gone,heir) :
+    unlink(repertoire,heir)
+    for link in repertoire.links.get(gone.key,[]) :
+        link.transposition = heir
+    heir.transposition = None
+    # (the heir keeps its own training, as gone's card leaves with it)
+    heir.variations = gone.variations
+    for child in heir.variations :
+        child.parent = heir
+    gone.variations = []
+    repertoire.positions[gone.key] = heir
+
+# makes a link the indexed node of its position, with the continuation, in
+# place of the node it links to, which stays in the tree as a link to it
+def take_over(repertoire,link) :
+    original = link.transposition
+    hand_over(repertoire,original,link)
+    original.transposition = link
+    repertoire.links.setdefault(original.key,[]).append(original)
+
+# keeps every position trainable: where an edit leaves the indexed node of a
+# position unreachable in training while a link to it is reachable, the link
+# takes the position over (so that a position is still trained once, where
+# it can be reached)
+# the given nodes are the roots of the subtrees the edit made reachable or
+# unreachable; returns the nodes that gained or lost a continuation
+def settle(repertoire,nodes) :
+    changed = []
+    stack = [(node,is_reachable(node)) for node in nodes]
+    while (len(stack) != 0) :
+        node, reachable = stack.pop()
+        if (node.transposition != None) :
+            if (reachable and not is_reachable(node.transposition)) :
+                changed.extend([node, node.transposition])
+                take_over(repertoire,node)
+        elif (not reachable and node.key in repertoire.links and repertoire.positions.get(node.key) is node) :
+            for link in repertoire.links[node.key] :
+                if (is_reachable(link)) :
+                    changed.extend([link, node])
+                    take_over(repertoire,link)
+                    # (the continuation is now reachable, from the link)
+                    stack.append((link,True))
+                    break
+        variations = node.variations
+        if (len(variations) != 0) :
+            if (node.player_to_move) :
+                stack.append((variations[0],reachable))
+                stack.extend((child,False) for child in variations[1:])
+            else :
+                stack.extend((child,reachable) for child in variations)
+    return changed
+
+# removes a move (and its continuation) from the tree, keeping the position
+# index in step; a removed position that is still linked to from elsewhere
+# is handed over to the first such link, along with its continuation (and
+# the positions are then settled)
+# returns the nodes that gained or lost a continuation
+def detach_move(node,move) :
+    repertoire = node.game()
+    child = node.variation(move)
+    # (deleting the main solution makes the next one reachable)
+    roots = []
+    if (node.player_to_move and node.variations[0] is child and len(node.variations) > 1 and is_reachable(node)) :
+        roots.append(node.variations[1])
+    node.remove_variation(move)
+    removed = set()
+    for gone in all_nodes(child) :
+        removed.add(gone.id)
+        repertoire.due.remove(gone)
+    heirs = []
+    orphans = []
+    stack = [child]
+    while (len(stack) != 0) :
+        gone = stack.pop()
+        if (gone.transposition != None) :
+            unlink(repertoire,gone)
+            continue
+        if (repertoire.positions.get(gone.key) is gone) :
+            links = [link for link in repertoire.links.get(gone.key,[]) if link.id not in removed]
+            if (len(links) != 0) :
+                hand_over(repertoire,gone,links[0])
+                heirs.append(links[0])
+                continue
+            del repertoire.positions[gone.key]
+            orphans.append(gone)
+        stack.extend(gone.variations)
+
+    # a continuation that was handed over may itself link to a removed
+    # position, which then passes (without its continuation) to that link
+    for gone in orphans :
+        if (gone.key in repertoire.links) :
+            gone.variations = []
+            heir = repertoire.links[gone.key][0]
+            hand_over(repertoire,gone,heir)
+            heirs.append(heir)
+    for heir in heirs :
+        reindex_due(repertoire,heir)
+    return heirs + settle(repertoire,roots + heirs)
+
+# promotes a move to the main variation, settling the positions
+# returns the nodes that gained or lost a continuation
+def promote_variation(node,move) :
+    demoted = node.variations[0]
+    node.promote(move)
+    if (not node.player_to_move or demoted is node.variations[0] or not is_reachable(node)) :
+        return []
+    return settle(node.game(),[demoted, node.variations[0]])
+
+#############
+# due index #
+#############
+
+# Every review position is filed in its repertoire's due index
+# (repertoire.due) under its due date, so the positions due by a given day,
+# and the review load of the days ahead, are found without walking the tree.
+# The index holds unreachable review positions too; they are filtered out
+# when it is read. It is kept in step by reindex_due whenever a node's
+# training data changes, and saved with the repertoire.
+
+# DueIndex - review positions bucketed by due date (as a day ordinal)
+class DueIndex :
+    def __init__(self) :
+        self.buckets = {}
+        self.days = []
+        self.ordinals = {}
+
+    def add(self, node) :
+        ordinal = node.training.due_date.toordinal()
+        bucket = self.buckets.get(ordinal)
+        if (bucket == None) :
+            bucket = self.buckets[ordinal] = {}
+            bisect.insort(self.days,ordinal)
+        bucket[node] = None
+        self.ordinals[node] = ordinal
+
+    def remove(self, node) :
+        ordinal = self.ordinals.pop(node,None)
+        if (ordinal == None) :
+            return
+        bucket = self.buckets[ordinal]
+        del bucket[node]
+        if (len(bucket) == 0) :
+            del self.buckets[ordinal]
+            del self.days[bisect.bisect_left(self.days,ordinal)]
+
+    # yields the indexed nodes due on or before the given date, earliest first
+    def due(self, date) :
+        last = bisect.bisect_right(self.days,date.toordinal())
+        for ordinal in self.days[:last] :
+            yield from self.buckets[ordinal]
+
+    # yields all the indexed nodes, earliest first
+    def nodes(self) :
+        for ordinal in self.days :
+            yield from self.buckets[ordinal]
+
+# builds the due index of a repertoire
+def index_due(repertoire) :
+    repertoire.due = DueIndex()
+    for node in all_nodes(repertoire) :
+        if (node.training and node.training.status == REVIEW) :
+            repertoire.due.add(node)
+
+# refiles a node whose training data has changed
+def reindex_due(repertoire,node) :
+    repertoire.due.remove(node)
+    if (node.training and node.training.status == REVIEW) :
+        repertoire.due.add(node)
+
+# checks whether a node is reachable in training (i.e. no player node on
+# the way to it leaves by an alternative solution)
+def is_reachable(node) :
+    while (node.parent != None) :
+        if (node.parent.player_to_move and node.parent.variations[0] is not node) :
+            return False
+        node = node.parent
+    return True
+
+# returns the reachable review positions due on or before the given date
+def get_due_nodes(repertoire,date) :
+    return [node for node in repertoire.due.due(date) if is_reachable(node)]
+
+# returns the number of reachable review positions due on each of the given
+# number of days from today (overdue positions count as due today)
+def get_forecast(repertoire,days) :
+    today = datetime.date.today().toordinal()
+    forecast = [0] * days
+    due = repertoire.due
+    last = bisect.bisect_right(due.days,today + days - 1)
+    for ordinal in due.days[:last] :
+        for node in due.buckets[ordinal] :
+            if (is_reachable(node)) :
+                forecast[max(ordinal - today, 0)] += 1
+    return forecast
+
+# returns the number of reachable review positions due on the given day
+def get_load(repertoire,ordinal) :
+    bucket = repertoire.due.buckets.get(ordinal,())
+    return sum(1 for node in bucket if is_reachable(node))
+
+##################
+# position cache #
+##################
+
+# python-chess sets up a node's board by replaying every move from the root,
+# so each repertoire keeps snapshots (copies without the move stack) of the
+# boards of recently used nodes (repertoire.position_cache). A node's board is
+# then set up from the nearest cached node on its line -- usually its parent.
+
+# the number of positions kept per repertoire
+position_cache_size = 4096
+
+# PositionCache - board snapshots of recently used nodes, least recently
+# used first
+class PositionCache :
+    def __init__(self, size = position_cache_size) :
+        self.size = size
+        self.boards = collections.OrderedDict()
+
+    # returns the cached snapshot of a node's position (not to be changed)
+    def snapshot(self, node) :
+        board = self.boards.get(node)
+        if (board != None) :
+            self.boards.move_to_end(node)
+            return board
+        # replay the line from the nearest cached node (or the root)
+        line = []
+        while (node.parent != None and node not in self.boards) :
+            line.append(node)
+            node = node.parent
+        if (node in self.boards) :
+            board = self.boards[node].copy(stack = False)
+        else :
+            board = node.board()
+            self.boards[node] = board.copy(stack = False)
+        for node in reversed(line) :
+            board.push(node.move)
+            self.boards[node] = board.copy(stack = False)
+        while (len(self.boards) > self.size) :
+            self.boards.popitem(last = False)
+        return self.boards[node]
+
+    # returns a new board set up at a node's position
+    def board(self, node) :
+        return self.snapshot(node).copy(stack = False)
 
 ##############
 # statistics #
@@ -171,50 +1980,584 @@ def get_scheduled_counts(node) :
     full_counts = get_counts(node)
     return [full_counts[0],full_counts[1]+full_counts[2],full_counts[5]]
 
-def get_counts(node) :
-    # new first second review inactive due reachable total
-    counts = [0,0,0,0,0,0,0]
-    if (node.training) :
-        status = node.training.status
-        due_date = node.training.due_date
-        # first five counts' statuses are handled as integers
-        for index in range(5) :
-            if (status == index) :
-                counts[index] += 1
-        # due count
-        if (status == REVIEW and due_date <= datetime.date.today()) :
-            counts[5] += 1
-        # increment reachable count
-        counts[6] += 1
-
-    # recursive part
+# Every node caches the counts for its reachable subtree (node.counts) and the
+# number of training positions in its whole subtree (node.total). The caches
+# are built by normalise, and refreshed along the path to the root by recount
+# whenever a node's training data or variations change.
+
+# the counts of a node alone are one of a few, so the cached counts of the
+# nodes without reachable children (most of a tree) are shared tuples: those
+# of a node without training first, then those of each status, due or not
+def make_own_counts(status,due) :
+    counts = [0,0,0,0,0,0,1]
+    counts[status] = 1
+    counts[5] = due
+    return tuple(counts)
+
+own_counts = [(0,0,0,0,0,0,0)] + [make_own_counts(status,due) for status in [NEW, FIRST_STEP, SECOND_STEP, REVIEW, INACTIVE] for due in [0, 1]]
+
+# returns the counts for the given node alone
+def get_own_counts(node) :
+    # new first second review inactive due reachable
+    if (not node.training) :
+        return own_counts[0]
+    status = node.training.status
+    # due count
+    due = status == REVIEW and node.training.due_date <= datetime.date.today()
+    return own_counts[1 + 2 * status + due]
+
+# sets a node's cached counts from its own data and its children's caches
+def set_counts(node) :
+    counts = get_own_counts(node)
+    total = counts[6]
     if (not node.is_end()) :
         if (node.player_to_move) :
-            # search only the main variation
-            child_counts = get_counts(node.variations[0])
-            for index in range(7) :
-                counts[index] += child_counts[index]
+            # only the main variation is reachable
+            reachable = node.variations[:1]
         else :
-            # search all variations
-            for child in node.variations :
-                child_counts = get_counts(child)
-                for index in range(7) :
-                    counts[index] += child_counts[index]
+            reachable = node.variations
+        counts = list(counts)
+        for child in reachable :
+            for index in range(7) :
+                counts[index] += child.counts[index]
+        counts = tuple(counts)
+        for child in node.variations :
+            total += child.total
+    node.counts = counts
+    node.total = total
 
-    return counts
+# builds the cached counts for a whole subtree
+def tally(node) :
+    traverse(node,[Counter()])
+
+# refreshes the cached counts of a changed node and all of its ancestors
+def recount(node) :
+    while (node != None) :
+        set_counts(node)
+        node = node.parent
+
+def get_counts(node) :
+    # new first second review inactive due reachable
+    return list(node.counts)
 
 def get_total_count(node) :
-    if (node.training) :
-        count = 1
-    else :
-        count = 0
-    if (not node.is_end()):
-        for child in node.variations :
-            count += get_total_count(child)                    
-    return count
+    return node.total
 
+# returns the earliest due date of the reachable review positions (or None)
+def get_next_due(repertoire) :
+    for node in repertoire.due.nodes() :
+        if (is_reachable(node)) :
+            return node.training.due_date
+    return None
+
+#############
+# traversal #
+#############
+
+# The jobs done over a whole repertoire tree (activating positions up to the
+# learning threshold, building the cached counts, collecting training cards)
+# are visitors, so that any of them can share a single walk of the tree.
+# traverse decides which nodes are reachable in training -- only the main
+# variation of a node with the player to move -- and calls each visitor's
+# enter on the way down (in playing order) and leave on the way back up.
+
+# Visitor - a job done over a tree (the default does nothing)
+class Visitor :
+    def enter(self, node, reachable) :
+        pass
+
+    def leave(self, node) :
+        pass
+
+# walks the subtree of the given node (iteratively, so deep trees are safe)
+def traverse(node,visitors) :
+    enters = [visitor.enter for visitor in visitors if type(visitor).enter is not Visitor.enter]
+    leaves = [visitor.leave for visitor in visitors if type(visitor).leave is not Visitor.leave]
+    # the reachable nodes are entered first, in preorder (i.e. in playing
+    # order), then the unreachable ones; every node is entered after its
+    # parent, so leaving them in reverse leaves each node after its subtree
+    order = []
+    stack = [node]
+    unreachable = []
+    while (len(stack) != 0) :
+        node = stack.pop()
+        order.append(node)
+        for enter in enters :
+            enter(node,True)
+        variations = node.variations
+        if (len(variations) != 0) :
+            if (node.player_to_move) :
+                unreachable.extend(variations[1:])
+                stack.append(variations[0])
+            else :
+                stack.extend(reversed(variations))
+    while (len(unreachable) != 0) :
+        node = unreachable.pop()
+        order.append(node)
+        for enter in enters :
+            enter(node,False)
+        unreachable.extend(node.variations)
+    for leave in leaves :
+        for node in reversed(order) :
+            leave(node)
+
+# Normaliser - activates reachable positions up to the learning threshold,
+# and deactivates the rest of the unlearned positions
+class Normaliser(Visitor) :
+    def __init__(self, threshold) :
+        self.threshold = threshold
+        self.changed = False
+
+    def enter(self, node, reachable) :
+        if (not reachable or not node.training) :
+            return
+        status = node.training.status
+        if (self.threshold <= 0) :
+            if (status == NEW or status == FIRST_STEP or status == SECOND_STEP) :
+                node.training.status = INACTIVE
+                self.changed = True
+        else :
+            if (status == INACTIVE) :
+                node.training.status = status = NEW
+                self.changed = True
+            if (status == NEW or status == FIRST_STEP or status == SECOND_STEP) :
+                self.threshold -= 1
+
+# Counter - builds the cached counts
+class Counter(Visitor) :
+    leave = staticmethod(set_counts)
+
+# CardCollector - collects the reachable positions waiting to be trained
+class CardCollector(Visitor) :
+    def __init__(self) :
+        self.nodes = []
+        self.today = datetime.date.today()
+
+    def enter(self, node, reachable) :
+        if (not reachable or not node.training) :
+            return
+        status = node.training.status
+        if (status == NEW or status == FIRST_STEP or status == SECOND_STEP
+            or (status == REVIEW and node.training.due_date <= self.today)) :
+            self.nodes.append(node)
+
+###############
+# stats index #
+###############
+
+# The stats index is a small JSON dictionary, stored alongside the
+# repertoires, which maps each repertoire filename to a summary of its counts
+# (with the dates as day ordinals). It lets the main menu be drawn without
+# opening any repertoire trees.
+
+# guards the stats index against the saver thread
+stats_lock = threading.Lock()
+
+# holds a thread lock, and an exclusive lock on a file next to the given
+# index, while the index is read and replaced: pool workers save repertoires,
+# and so update the indexes, at the same time as each other
+@contextlib.contextmanager
+def index_lock(lock,path) :
+    with lock :
+        if (fcntl == None) :
+            yield
+            return
+        with open(path + ".lock", "a") as file :
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try :
+                yield
+            finally :
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+# returns the path to the stats index
+def stats_index_path() :
+    return rep_path + "/.stats"
+
+# returns a stats index entry as JSON data
+def encode_stats_entry(entry) :
+    data = dict(entry)
+    data["date"] = entry["date"].toordinal()
+    if (entry["next_due"] != None) :
+        data["next_due"] = entry["next_due"].toordinal()
+    return data
+
+# restores a stats index entry from JSON data
+def decode_stats_entry(data) :
+    entry = dict(data)
+    entry["date"] = datetime.date.fromordinal(data["date"])
+    if (data["next_due"] != None) :
+        entry["next_due"] = datetime.date.fromordinal(data["next_due"])
+    return entry
+
+# loads the stats index (an empty index if it is missing or unreadable, as
+# is one pickled by older versions)
+def load_stats_index() :
+    try :
+        with open(stats_index_path(), "rb") as file :
+            data = json.load(file)
+        return {filename : decode_stats_entry(entry) for filename, entry in data.items()}
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) :
+        return {}
+
+# saves the stats index (written to a temporary file, then swapped in)
+# the temporary file is per process, as pool workers may save it at once
+def save_stats_index(index) :
+    path = stats_index_path()
+    temporary = path + "." + str(os.getpid()) + ".tmp"
+    data = {filename : encode_stats_entry(entry) for filename, entry in index.items()}
+    with open(temporary, "w") as file :
+        json.dump(data,file)
+    os.replace(temporary, path)
+
+# returns the modification times and sizes of a repertoire file, its training
+# state and its journal
+def file_signature(filename) :
+    signature = []
+    for path in [rep_path + "/" + filename, state_path(rpt_name(filename)), journal_path(rpt_name(filename))] :
+        try :
+            stat = os.stat(path)
+            signature += [stat.st_mtime_ns, stat.st_size]
+        except OSError :
+            signature += [0, 0]
+    return signature
+
+# builds a stats index entry for a freshly updated repertoire
+def make_stats_entry(filename,repertoire) :
+    return {
+        "signature" : file_signature(filename),
+        "date" : datetime.date.today(),
+        "name" : repertoire.meta.name,
+        "counts" : get_counts(repertoire),
+        "total" : get_total_count(repertoire),
+        "next_due" : get_next_due(repertoire),
+    }
+
+# stores a fresh stats index entry for a repertoire
+def refresh_stats_entry(repertoire) :
+    filename = repertoire.meta.name + ".rpt"
+    store_stats_entry(filename,make_stats_entry(filename,repertoire))
+
+# stores a stats index entry, signed with the repertoire's current files
+# (the saver thread stores entries too, hence the lock)
+def store_stats_entry(filename,entry) :
+    with index_lock(stats_lock,stats_index_path()) :
+        entry["signature"] = file_signature(filename)
+        index = load_stats_index()
+        index[filename] = entry
+        save_stats_index(index)
+
+# checks whether a stats index entry still describes the repertoire file
+def is_valid_stats_entry(entry,filename) :
+    if (entry == None or entry.get("signature") != file_signature(filename)) :
+        return False
+    # the counts only change with the date when a new day activates inactive
+    # positions or brings review positions due
+    today = datetime.date.today()
+    if (entry["date"] == today) :
+        return True
+    next_due = entry["next_due"]
+    return entry["counts"][4] == 0 and (next_due == None or next_due > today)
+
+# returns up to date stats entries for the given repertoire filenames,
+# opening only the repertoires whose entries are missing or stale
+def get_stats_entries(filenames) :
+    saver.wait()
+    if (use_database()) :
+        # (opening the stale repertoires brings their rows up to date)
+        stale = [filename for filename in filenames if query_stats_entry(rpt_name(filename)) == None]
+        map_repertoires(summarise_repertoire,stale)
+        return [query_stats_entry(rpt_name(filename)) for filename in filenames]
+    index = load_stats_index()
+    stale = [filename for filename in filenames if not is_valid_stats_entry(index.get(filename),filename)]
+    fresh = dict(zip(stale, map_repertoires(summarise_repertoire,stale)))
+    # (entries for deleted repertoires are dropped)
+    gone = [filename for filename in index if filename not in filenames]
+    if (len(fresh) != 0 or len(gone) != 0) :
+        # the index is read again, as other processes may have stored entries
+        # meanwhile
+        with index_lock(stats_lock,stats_index_path()) :
+            index = load_stats_index()
+            index.update(fresh)
+            for filename in gone :
+                index.pop(filename,None)
+            save_stats_index(index)
+    return [fresh.get(filename) or index[filename] for filename in filenames]
+
+##################
+# position index #
+##################
+
+# The position index (Repertoires/.positions) lists, for every repertoire in
+# the folder, the positions reachable in training with the player to move,
+# along with their main solutions and the training statuses of those, so that
+# a position can be looked up across all the repertoires without opening any
+# of them: the index is sorted by position key, and searched in place. A
+# repertoire's entries are replaced whenever it is saved, and those of a
+# repertoire whose files have changed since (a session's journal, say) when
+# the index is next refreshed. A folder with a database answers the lookup
+# from the node rows instead (see the database section).
+#
+# header      magic, version, (reserved), table length, entry count
+# table       JSON list of the indexed repertoires, as pairs of name and the
+#             signature of the files the entries were taken from, journal
+#             included (null for a free slot)
+# entries     16 bytes each, in the Polyglot book layout (big-endian): key
+#             (uint64), move (uint16), weight (uint16) and learn (uint32),
+#             sorted by key; the weight is the repertoire's place in the table
+#             (from 1), and learn the training status of the solution
+#
+# A Polyglot move is to square | from square << 6 | (promotion - 1) << 12,
+# with castling as the king's two square move.
+
+position_index_magic = b"OTPI"
+position_index_version = 1
+position_index_header = struct.Struct("<4sHHII")
+position_entry = struct.Struct(">QHHI")
+position_key_field = struct.Struct(">Q")
+
+# the learn field of a solution without training
+NO_STATUS = 0xFFFFFFFF
+
+# guards the position index against the saver thread
+positions_lock = threading.Lock()
+
+# returns the path to the position index
+def position_index_path() :
+    return rep_path + "/.positions"
+
+# packs a move in the Polyglot layout
+def encode_polyglot_move(move) :
+    promotion = move.promotion - 1 if move.promotion else 0
+    return move.to_square | move.from_square << 6 | promotion << 12
+
+# unpacks a move from the Polyglot layout
+def decode_polyglot_move(value) :
+    promotion = value >> 12 & 7
+    return chess.Move(value >> 6 & 63, value & 63, promotion + 1 if promotion else None)
+
+# returns the position index entries of a repertoire, as triples of key,
+# move and status (without the weight, which is the index's business)
+def make_position_entries(repertoire) :
+    entries = []
+    stack = [repertoire]
+    while (len(stack) != 0) :
+        node = stack.pop()
+        variations = node.variations
+        if (len(variations) == 0) :
+            continue
+        if (node.player_to_move) :
+            solution = variations[0]
+            status = solution.training.status if solution.training else NO_STATUS
+            entries.append((node.key, encode_polyglot_move(solution.move), status))
+            stack.append(solution)
+        else :
+            stack.extend(variations)
+    return entries
+
+# loads the position index, as its table and its entries (bytes)
+# (an empty index if it is missing or unreadable)
+def load_position_index() :
+    try :
+        with open(position_index_path(), "rb") as file :
+            data = file.read()
+        magic, version, reserved, table_length, count = position_index_header.unpack_from(data)
+        if (magic != position_index_magic or version != position_index_version) :
+            return [], b""
+        start = position_index_header.size + table_length
+        table = json.loads(data[position_index_header.size:start])
+        return table, data[start:start + count * position_entry.size]
+    except (OSError, ValueError, struct.error) :
+        return [], b""
+
+# saves the position index (written to a temporary file, then swapped in)
+def save_position_index(table,entries) :
+    path = position_index_path()
+    temporary = path + "." + str(os.getpid()) + ".tmp"
+    table = json.dumps(table).encode()
+    count = len(entries) // position_entry.size
+    with open(temporary, "wb") as file :
+        file.write(position_index_header.pack(position_index_magic, position_index_version, 0, len(table), count))
+        file.write(table)
+        file.write(entries)
+    os.replace(temporary, path)
+
+# replaces the entries of the given repertoires (a dictionary of filenames
+# and entries, None dropping a repertoire from the index)
+def store_position_entries(changes) :
+    if (use_database()) :
+        return
+    with index_lock(positions_lock,position_index_path()) :
+        table, entries = load_position_index()
+        names = [slot and slot[0] for slot in table]
+        numbers = {}
+        for filename, changed in changes.items() :
+            name = rpt_name(filename)
+            if (name in names) :
+                number = names.index(name) + 1
+            elif (changed == None) :
+                continue
+            else :
+                # (a new repertoire takes the first free slot)
+                if (None not in names) :
+                    names.append(None)
+                    table.append(None)
+                number = names.index(None) + 1
+                names[number - 1] = name
+            numbers[number] = changed
+            if (changed == None) :
+                table[number - 1] = None
+            else :
+                table[number - 1] = [name, file_signature(filename)]
+
+        # the entries sort as bytes, as they are big-endian
+        size = position_entry.size
+        weights = set(struct.pack(">H", number) for number in numbers)
+        records = [entries[index:index + size] for index in range(0, len(entries), size)
+                   if entries[index + 10:index + 12] not in weights]
+        for number, changed in numbers.items() :
+            if (changed != None) :
+                records.extend(position_entry.pack(key, move, number, status) for key, move, status in changed)
+        records.sort()
+        save_position_index(table,b"".join(records))
+
+# opens a repertoire and returns its position index entries
+def index_repertoire(filename) :
+    repertoire = open_repertoire(filename)
+    repertoire.journal.close()
+    return make_position_entries(repertoire)
+
+# brings the position index up to date with the folder, indexing again only
+# the repertoires whose files have changed since they were indexed (their
+# journals, say, or by another version of the trainer, or another program)
+# a repertoire to skip may be given: one open for management, whose journal
+# grows with every edit
+def refresh_position_index(skip=None) :
+    if (use_database()) :
+        return
+    filenames = list_repertoires()
+    with positions_lock :
+        table, entries = load_position_index()
+    indexed = dict(slot for slot in table if slot != None)
+    stale = [filename for filename in filenames
+             if filename != skip and indexed.get(rpt_name(filename)) != file_signature(filename)]
+    changes = dict(zip(stale, map_repertoires(index_repertoire,stale)))
+    for name in indexed :
+        if (name + ".rpt" not in filenames) :
+            changes[name + ".rpt"] = None
+    if (len(changes) != 0) :
+        saver.wait()
+        store_position_entries(changes)
+
+# returns the repertoires which hold the given position, as triples of name,
+# main solution and its status (None if it has no training), by name
+def find_position(board) :
+    key = position_key(board)
+    if (use_database()) :
+        return query_position(key)
+    saver.wait()
+    found = []
+    try :
+        file = open(position_index_path(), "rb")
+    except FileNotFoundError :
+        return found
+    with file :
+        header = file.read(position_index_header.size)
+        try :
+            magic, version, reserved, table_length, count = position_index_header.unpack(header)
+        except struct.error :
+            return found
+        if (magic != position_index_magic or version != position_index_version) :
+            return found
+        table = json.loads(file.read(table_length))
+        start = position_index_header.size + table_length
+        # binary search for the first entry with the key, reading only the
+        # keys on the way
+        low = 0
+        high = count
+        while (low < high) :
+            middle = (low + high) // 2
+            file.seek(start + middle * position_entry.size)
+            if (position_key_field.unpack(file.read(position_key_field.size))[0] < key) :
+                low = middle + 1
+            else :
+                high = middle
+        file.seek(start + low * position_entry.size)
+        for index in range(low, count) :
+            entry_key, move, weight, status = position_entry.unpack(file.read(position_entry.size))
+            if (entry_key != key) :
+                break
+            slot = table[weight - 1]
+            if (slot != None) :
+                found.append((slot[0], decode_polyglot_move(move), None if status == NO_STATUS else status))
+    return sorted(found, key = lambda entry : entry[0])
+
+# names of the training statuses, for the position lookup
+status_names = ["new", "learning", "learning", "in review", "inactive"]
+
+# returns the name of a training status (None for no training)
+def status_name(status) :
+    if (status == None) :
+        return "not trained"
+    return status_names[status]
+
+###################
+# bulk operations #
+###################
+
+# Opening a repertoire is CPU bound (decoding, normalising and counting), so
+# operations over many repertoires spread them across a pool of processes.
+
+# sets the data directory (in a pool worker)
+def set_rep_path(path) :
+    global rep_path
+    rep_path = path
+
+# runs `task' (a module level function taking a repertoire filename) over the
+# given repertoires, returning the results in order
+def map_repertoires(task,filenames) :
+    # the workers must not find files half saved
+    saver.wait()
+    workers = min(len(filenames), os.cpu_count() or 1)
+    if (workers < 2) :
+        return [task(filename) for filename in filenames]
+    chunksize = max(1, len(filenames) // (workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers, initializer = set_rep_path, initargs = (rep_path,)) as pool :
+        return list(pool.map(task,filenames,chunksize = chunksize))
+
+# opens a repertoire and returns its stats index entry
+def summarise_repertoire(filename) :
+    return make_stats_entry(filename,open_repertoire(filename))
+
+# migrates a repertoire if it is still in the pickled format, returning its
+# filename if it was
+def migrate_file(filename) :
+    if (use_database()) :
+        return None
+    with open(rep_path + "/" + filename, "rb") as file :
+        magic = file.read(4)
+    if (magic == rpt_magic) :
+        return None
+    open_repertoire(filename).journal.close()
+    return filename
+
+# opens a repertoire and saves it with its scheduling brought up to date
+def normalise_file(filename) :
+    save_repertoire(open_repertoire(filename))
+    saver.wait()
+
+# opens a repertoire and returns its counts, with the review positions due by
+# the given date (as pairs of FEN and solution) if asked for
+def summarise_due(date,positions,filename) :
+    repertoire = open_repertoire(filename)
+    nodes = get_due_nodes(repertoire,date)
+    summary = {"name" : repertoire.meta.name, "counts" : get_counts(repertoire), "due" : len(nodes)}
+    if (positions) :
+        summary["positions"] = []
+        for node in nodes :
+            board = repertoire.position_cache.board(node.parent)
+            summary["positions"].append((board.fen(), board.san(node.move)))
+    return summary
 
-        
 #############
 # main menu #
 #############
@@ -222,7 +2565,7 @@ def get_total_count(node) :
 def main_menu():
     command = ""
     while(command != "q") :
-        filenames = os.listdir(rep_path)    
+        filenames = list_repertoires()
         clear()
         print_main_overview(filenames)
         print_main_options(filenames)
@@ -251,9 +2594,9 @@ def print_main_overview(filenames) :
     print(header)
     
     # print the stats for each repertoire
-    for index, filename in enumerate(filenames) :
-        repertoire = open_repertoire(filename)
-        counts = get_counts(repertoire)
+    entries = get_stats_entries(filenames)
+    for index, entry in enumerate(entries) :
+        counts = entry["counts"]
         id = index + 1
         if (counts[6] != 0) :
             coverage = int(round(counts[3] / counts[6] * 100))
@@ -265,7 +2608,7 @@ def print_main_overview(filenames) :
             info += (str(coverage) + "% ").rjust(5)
         else :
             info += "".ljust(5)
-        info += str(repertoire.meta.name).ljust(name_width)
+        info += str(entry["name"]).ljust(name_width)
         info += str(waiting).ljust(9)
         info += str(learned).ljust(9)
         info += str(total).ljust(7)
@@ -298,18 +2641,34 @@ def new_repertoire() :
         colour = input(":")
     player = colour == "w"
     name = input("\nName:")
-    while (os.path.exists(rpt_path(name))) :
+    while (repertoire_exists(name)) :
         name = input("That name is taken.\nChoose another:")
 
     # create the repertoire
+    rpt = make_repertoire(board,name,player)
+    save_repertoire(rpt)
+    clear()
+    print(f"Repertoire {name} created.")
+
+# returns an empty repertoire starting from the given position
+def make_repertoire(board,name,player) :
     rpt = chess.pgn.Game()
     rpt.setup(board)
     rpt.meta = MetaData(name, player)
     rpt.training = False
     rpt.player_to_move = player == board.turn
-    save_repertoire(rpt)
-    clear()
-    print(f"Repertoire {name} created.")
+    rpt.generation = 0
+    rpt.edited = True
+    rpt.lazy = False
+    rpt.nodes = [rpt]
+    rpt.id = 0
+    rpt.journal = None
+    rpt.key = position_key(board)
+    rpt.transposition = None
+    rpt.due = DueIndex()
+    rpt.position_cache = PositionCache()
+    index_positions(rpt)
+    return rpt
 
 # TODO - rewrite this function into the current style
 # prompts user to choose starting position
@@ -352,7 +2711,16 @@ def repertoire_menu(filename) :
         print_repertoire_options(repertoire,counts)
         command = input("\n:")
         if (command == "m") :
+            # (management opens the repertoire lazily, so the full tree isn't
+            # kept meanwhile)
+            repertoire = None
             manage(filename)
+        elif (command == "i") :
+            import_menu(filename)
+        elif (command == "f") :
+            forecast_menu(repertoire)
+        elif (command == "o") :
+            options_menu(repertoire)
         elif (command == "t") :
             train(filename)
 
@@ -385,31 +2753,100 @@ def print_repertoire_overview(repertoire,counts) :
 def print_repertoire_options(repertoire,counts) :
     status = repertoire.meta.status
     print("\n'm' manage")
+    print("'i' import")
+    print("'f' forecast")
+    print("'o' options")
     if (counts[0] + counts[1] + counts[2] + counts[5] > 0) :
         print("\n't' train")
     print("'c' close")
 
+# shows the number of reviews due on each of the coming days
+def forecast_menu(repertoire) :
+    days = 14
+    bar_width = 40
+    command = ""
+    while (command != "c") :
+        forecast = get_forecast(repertoire,days)
+        today = datetime.date.today()
+        scale = max(1, -(-max(forecast) // bar_width))
+        clear()
+        print("Repertoire: " + repertoire.meta.name)
+        print(f"Reviews due over the next {days} days")
+        print("")
+        for offset in range(days) :
+            if (offset == 0) :
+                label = "Today"
+            else :
+                label = (today + datetime.timedelta(days=offset)).strftime("%a %d %b")
+            bar = "#" * -(-forecast[offset] // scale)
+            print(label.ljust(14) + str(forecast[offset]).rjust(6) + "  " + bar)
+        print("\nEnter a number of days, or 'c' to close")
+        command = input("\n:")
+        if (represents_int(command) and int(command) > 0) :
+            days = int(command)
+
+# sets the scheduling options of the repertoire
+def options_menu(repertoire) :
+    meta = repertoire.meta
+    changed = False
+    command = ""
+    while (command != "c") :
+        clear()
+        print("Repertoire: " + meta.name)
+        print("")
+        print("Load balancing: " + ("on" if meta.load_balancing else "off"))
+        print(f"Tolerance:      {int(round(meta.balance_tolerance * 100))}% of the interval")
+        print("Review cap:     " + (f"{meta.review_cap} a day" if meta.review_cap > 0 else "none"))
+        print("\n'b' toggle load balancing")
+        print("'t' set the tolerance (percent)")
+        print("'r' set the review cap (0 for none)")
+        print("'c' close")
+        command = input("\n:")
+        if (command == "b") :
+            meta.load_balancing = not meta.load_balancing
+            changed = True
+        elif (command == "t") :
+            value = input("Tolerance: ")
+            if (represents_int(value) and 0 <= int(value) <= 100) :
+                meta.balance_tolerance = int(value) / 100
+                changed = True
+        elif (command == "r") :
+            value = input("Review cap: ")
+            if (represents_int(value) and int(value) >= 0) :
+                meta.review_cap = int(value)
+                changed = True
+    # (the options aren't journaled, so the file is saved)
+    if (changed) :
+        repertoire.edited = True
+        save_repertoire(repertoire)
+
 ###############
 # manage menu #
 ###############
 
 # the top level management dialogue
 def manage(filename):
-    repertoire = open_repertoire(filename)
+    # (the coverage of the positions is looked up in the other repertoires)
+    refresh_position_index(filename)
+    repertoire = open_lazily(filename)
     player = repertoire.meta.player
-    board = repertoire.board()
     node = repertoire        
+    # the nodes visited on the way here (a transposition can jump lines, so
+    # node.parent is not necessarily the way back)
+    path = []
 
     command = ""
     while(command != "c") :
+        board = repertoire.position_cache.board(node)
 
         clear()
         print_node_overview(node,player,board)
+        if (node.player_to_move) :
+            print_coverage(board,repertoire.meta.name)
         print_node_options(node)
         command = input("\n:")
-        if (command == "b" and node.parent != None) :
-            node = node.parent
-            board.pop()
+        if (command == "b" and len(path) != 0) :
+            node = path.pop()
         elif (command == "d" and len(node.variations) != 0) :
             delete_move(node,board)
             
@@ -419,11 +2856,13 @@ def manage(filename):
         elif (is_valid_uci(command,board)) :
             move = chess.Move.from_uci(command)
             if (not node.has_variation(move)) :
-                add_move(node,move)
+                add_move(node,move,board)
+            path.append(node)
             node = node.variation(move)
-            board.push(move)
+            if (node.transposition != None) :
+                node = node.transposition
 
-    save_repertoire(repertoire)    
+    close_repertoire(repertoire)
     clear()
     print(f"Saved {rpt_name(filename)}.")
 
@@ -433,6 +2872,15 @@ def print_node_overview(node,player,board) :
     print_board(board,player)
     print_moves(node)
 
+# prints the other repertoires which cover the position (from the position
+# index, as refreshed when management opened)
+def print_coverage(board,name) :
+    found = [entry for entry in find_position(board) if entry[0] != name]
+    if (len(found) != 0) :
+        print("\nAlso in:")
+        for other, move, status in found :
+            print(f"{other}: {move.uci()} ({status_name(status)})")
+
 # prints the management options for a given node
 def print_node_options(node) :
     print("")
@@ -454,7 +2902,10 @@ def delete_move(node,board) :
             print(f"You are about to permanently delete the move '{command}'.")
             command = input("are you sure:")
             if (command == "y") :
-                node.remove_variation(move)
+                journal_edit(node.game(),DELETE_RECORD,node,move)
+                for changed in detach_move(node,move) :
+                    recount(changed)
+                recount(node)
 
 # promotes a move in the repertoire move tree
 def promote_move(node,board) :
@@ -462,80 +2913,312 @@ def promote_move(node,board) :
     if (is_valid_uci(command,board)) :
         move = chess.Move.from_uci(command)
         if (node.has_variation(move)) :
-            node.promote(move)
+            journal_edit(node.game(),PROMOTE_RECORD,node,move)
+            for changed in promote_variation(node,move) :
+                recount(changed)
+            recount(node)
 
 # adds a move to the repertoire move tree
-def add_move(node,move) :
-    new_node = node.add_variation(move)
+# (the board, if given, must be at the node)
+def add_move(node,move,board=None) :
+    journal_edit(node.game(),ADD_RECORD,node,move)
+    new_node = attach_move(node,move,board)
+    recount(new_node)
+    # (a new link that took its position over leaves the former node of the
+    # position among the links, without its continuation)
+    if (new_node.transposition == None) :
+        for link in node.game().links.get(new_node.key,[]) :
+            recount(link)
+
+# adds a move to the tree, setting up its node (but not its cached counts)
+# a move into a position already in the repertoire adds a link to it (which
+# takes the position over if it's reachable in training and the position's
+# node isn't)
+def attach_move(node,move,board=None) :
+    repertoire = node.game()
+    if (board == None) :
+        board = repertoire.position_cache.board(node)
+    board.push(move)
+    key = position_key(board)
+    board.pop()
+
+    new_node = node_class()(node,move)
+    new_node.id = len(repertoire.nodes)
+    repertoire.nodes.append(new_node)
     new_node.player_to_move = not node.player_to_move
-    if (node.parent == None or new_node.player_to_move) :
-        new_node.training = False        
-    else :
+    new_node.key = key
+    if (is_card(new_node)) :
         new_node.training = TrainingData()
+    else :
+        new_node.training = False
+    new_node.transposition = repertoire.positions.get(key)
+    if (new_node.transposition != None) :
+        repertoire.links.setdefault(key,[]).append(new_node)
+        settle(repertoire,[new_node])
+    else :
+        repertoire.positions[key] = new_node
+    return new_node
 
 # sets training position statuses based on the current environment
 # for example, after management changes or the passage of time
-def normalise(node,threshold) :
-    # configure training data
-    if (node.training) :
-        if (threshold <= 0) :
-            for status in [NEW,FIRST_STEP,SECOND_STEP] :
-                if (node.training.status == status) :
-                    node.training.status = INACTIVE
-        else : # threshold exceeds 0
-            if (node.training.status == INACTIVE) :
-                node.training.status = NEW
-            for status in [NEW,FIRST_STEP,SECOND_STEP] :
-                if (node.training.status == status) :
-                    threshold -= 1
+# (and builds the cached counts); any further visitors share the walk
+# returns whether any status changed
+def normalise(node,threshold,visitors=[]) :
+    normaliser = Normaliser(threshold)
+    traverse(node,[normaliser, Counter()] + visitors)
+    return normaliser.changed
 
-    if (not node.is_end()) :
-        if (node.player_to_move) : # call all children recursively
-            threshold = normalise(node.variations[0],threshold)
-        else : # call only the main variation
-            for child in node.variations :
-                threshold = normalise(child,threshold)
-                
-    return threshold
+###############
+# import menu #
+###############
+
+# imports the games of a PGN file into the repertoire `filename'
+def import_menu(filename) :
+    path = input("\nPGN file:")
+    if (not os.path.isfile(path)) :
+        print("No such file.")
+        input("\nHit [enter] to continue.")
+        return
+    repertoire = open_repertoire(filename)
+    games, seconds = import_pgn(repertoire,path)
+    save_repertoire(repertoire)
+    clear()
+    print(f"Imported {games} games into {rpt_name(filename)}.")
+    if (seconds > 0) :
+        print(f"({int(games / seconds)} games per second)")
+    input("\nHit [enter] to continue.")
+
+# RepertoireImporter - a PGN visitor which merges each move into the
+# repertoire as it is read, so no game trees are built and memory stays
+# bounded however large the file is
+# moves are only merged once a game reaches the repertoire's starting position
+# (import_pgn mixes in python-chess's BaseVisitor for the other visitor
+# methods, so that python-chess isn't needed to load this module)
+class RepertoireImporter :
+    def __init__(self, repertoire) :
+        self.repertoire = repertoire
+        self.root_ply = repertoire.board().ply()
+        self.games = 0
+        self.errors = 0
+
+    def begin_game(self) :
+        # the repertoire nodes at the current position and before the last
+        # move (None while the game is outside the repertoire)
+        self.node = None
+        self.previous = None
+        self.stack = []
+
+    def visit_move(self, board, move) :
+        if (self.node == None and board.ply() == self.root_ply) :
+            if (position_key(board) == self.repertoire.key) :
+                self.node = self.repertoire
+        self.previous = self.node
+        if (self.node != None) :
+            if (self.node.has_variation(move)) :
+                child = self.node.variation(move)
+            else :
+                child = attach_move(self.node,move,board)
+            if (child.transposition != None) :
+                child = child.transposition
+            self.node = child
+
+    # a variation is an alternative to the last move
+    def begin_variation(self) :
+        self.stack.append((self.node,self.previous))
+        self.node = self.previous
+
+    def end_variation(self) :
+        self.node, self.previous = self.stack.pop()
+
+    # illegal or unreadable moves end the line they occur in
+    def handle_error(self, error) :
+        self.errors += 1
+
+    def end_game(self) :
+        self.games += 1
+
+    def result(self) :
+        return self.games
+
+# merges all the games (and their variations) of a PGN file into a
+# repertoire, streaming the file one game at a time
+# the moves are added with attach_move, so the caller must save the
+# repertoire (which rebuilds the cached counts) afterwards
+# returns the number of games read and the time taken
+def import_pgn(repertoire,path) :
+    visitor = type("RepertoireImporter", (RepertoireImporter, chess.pgn.BaseVisitor), {})
+    importer = visitor(repertoire)
+    start = time.perf_counter()
+    with open(path, encoding = "utf-8-sig", errors = "replace") as handle :
+        while (chess.pgn.read_game(handle, Visitor = lambda : importer) != None) :
+            pass
+    repertoire.edited = True
+    return importer.games, time.perf_counter() - start
 
 ##############
 # train menu #
 ##############
 
+# Card - a training position: the solution node, and the board (a snapshot,
+# not to be changed) on which the solution is to be played
+Card = collections.namedtuple("Card", ["node", "board"])
+
+# TrainingQueue - the cards of a training session, in playing order
+# cards are drawn lazily from the given iterable, and only ever reinserted a
+# few places ahead, so a deque gives O(1) pops from the front and O(offset)
+# reinsertion
+# with a `lookahead', a background thread keeps that many cards drawn and
+# rendered ahead of the session, so that the next card is ready as soon as
+# the user answers; the session itself only ever touches the deque under the
+# queue's lock
+class TrainingQueue :
+    def __init__(self, cards, player = None, lookahead = 0) :
+        self.source = iter(cards)
+        self.cards = collections.deque()
+        self.player = player
+        self.lookahead = lookahead
+        # the rendered views of cards waiting in the queue, by node
+        self.views = {}
+        # (the lock is taken directly, which is cheaper than through the
+        # condition)
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.closed = False
+        self.error = None
+        if (lookahead > 0) :
+            threading.Thread(target = self.prefetch, name = "prefetch", daemon = True).start()
+
+    # draws cards from the source until `count' are waiting (or it runs out)
+    def fill(self, count) :
+        while (len(self.cards) < count) :
+            card = next(self.source, None)
+            if (card == None) :
+                break
+            self.cards.append(card)
+
+    # tells the background thread (if there is one) that the queue has changed
+    # (the caller holds the lock)
+    def wake(self) :
+        if (self.lookahead > 0) :
+            self.condition.notify()
+
+    # raises the error which stopped the background thread, if any
+    def check(self) :
+        if (self.error != None) :
+            raise self.error
+
+    def is_empty(self) :
+        with self.lock :
+            self.check()
+            self.fill(1)
+            return len(self.cards) == 0
+
+    # removes and returns the next card
+    def pop(self) :
+        with self.lock :
+            self.check()
+            self.fill(1)
+            card = self.cards.popleft()
+            self.wake()
+            return card
+
+    # puts a card back `offset' places ahead (at the end if the queue is shorter)
+    def reinsert(self, card, offset) :
+        with self.lock :
+            self.fill(offset)
+            self.cards.insert(min(offset, len(self.cards)), card)
+            self.wake()
+
+    # returns the rendered front and back of a card taken from the queue,
+    # rendering it now if the background thread hasn't got to it
+    def view(self, card) :
+        with self.lock :
+            view = self.views.pop(card.node, None)
+        if (view == None) :
+            view = render_card(card,self.player)
+        return view
+
+    # stops the background thread
+    def close(self) :
+        with self.lock :
+            self.closed = True
+            self.condition.notify_all()
+
+    # the background thread: draws the next `lookahead' cards and renders
+    # those without a view (a card is rendered outside the lock, as its board
+    # is a snapshot which nothing else changes)
+    def prefetch(self) :
+        try :
+            while (True) :
+                with self.lock :
+                    card = None
+                    while (not self.closed) :
+                        self.fill(self.lookahead)
+                        card = next((card for card in itertools.islice(self.cards, self.lookahead)
+                                     if card.node not in self.views), None)
+                        if (card != None) :
+                            break
+                        self.condition.wait()
+                    if (self.closed) :
+                        return
+                view = render_card(card,self.player)
+                with self.lock :
+                    self.views[card.node] = view
+        except Exception as error :
+            with self.lock :
+                self.error = error
+
+# returns the front and back of a card as rendered boards: the position, and
+# the position after the solution
+def render_card(card,player) :
+    board = card.board.copy(stack = False)
+    front = render_board(board,player)
+    board.push(card.node.move)
+    return front, render_board(board,player)
+
 # runs training routine for the given repertoire `filename'
 def train(filename):
-    repertoire = open_repertoire(filename)
+    # the cards are collected as the repertoire is opened (or, from a
+    # database, queried once it's open)
+    if (use_database()) :
+        repertoire = open_repertoire(filename)
+        cards = query_cards(repertoire)
+    else :
+        collector = CardCollector()
+        repertoire = open_repertoire(filename,[collector])
+        cards = collector.nodes
     player = repertoire.meta.player
-    board = repertoire.board()
-    node = repertoire        
 
     # generate queue
-    queue = generate_training_queue(repertoire,board)
+    # (the next cards are prepared while the user thinks about the current one)
+    queue = TrainingQueue(make_cards(repertoire,cap_reviews(repertoire,cards)),
+                          player, lookahead = 2)
 
     # play queue
-    command = ""
-    while(len(queue) != 0) :
-        card = queue.pop(0)
+    while(not queue.is_empty()) :
+        card = queue.pop()
         counts = get_counts(repertoire)
         clear()
         print(f"{counts[0]} {counts[1]} {counts[2]} {counts[5]}")
-        result = play_card(card,repertoire)
+        result = play_card(card,repertoire,queue.view(card))
         if (result == "CLOSE") :
             break
         handle_card_result(result,card,queue,repertoire)
+    queue.close()
 
     # save and quit trainer
-    save_repertoire(repertoire)
+    close_repertoire(repertoire)
 
-# plays the given card to the user    
-def play_card(card,repertoire) :
-    root = card[0]
-    node = card[1]
+# plays the given card to the user, with its rendered `view' if it has been
+# prepared
+def play_card(card,repertoire,view = None) :
+    node = card.node
     status = node.training.status
     player = repertoire.meta.player
+    if (view == None) :
+        view = render_card(card,player)
 
     # front of card
-    front = root.variations[0]
     if (status == 0) :
         print("\nNEW : this is a position you haven't seen before")
     if (status == 1 or status == 2) :
@@ -543,7 +3226,7 @@ def play_card(card,repertoire) :
     if (status == 3) :
         print("\nRECALL : this is a position you've learned, due for recall")
 
-    print_board(front.board(),player)
+    print("\n" + view[0])
     if (status == 0) :
         print("\nGuess the move..")
     else :
@@ -554,10 +3237,9 @@ def play_card(card,repertoire) :
         return "CLOSE"
 
     # back of card
-    back = front.variations[0]
     clear()    
     print("Solution:")
-    print_board(back.board(),player)
+    print("\n" + view[1])
 
     if (status == 0) :
         print("\nHit [enter] to continue.")
@@ -577,120 +3259,437 @@ def play_card(card,repertoire) :
             return "CLOSE"
         uci = input(":")
         
+# scheduling parameters (the simulator, simulate.py, models them too)
+# a newly learned position is first due after `first_gap' days, or after
+# `easy_first_gap' days if its second step was easy
+first_gap = 1
+easy_first_gap = 3
+# each recall multiplies the gap by a random factor between the multiplier
+# for the answer and one more
+ok_multiplier = 2
+easy_multiplier = 3
+
+# In load balancing mode (an option of each repertoire), a position is not
+# due exactly `gap' days after its recall, but on the day with the fewest
+# recalls due within `balance_tolerance' of the gap (the closest to the gap
+# in a tie). With a review cap (which applies with or without load
+# balancing), days which already have that many recalls due are passed over,
+# and a session holds no more than that many recalls.
+
+# returns the due date of a position recalled today with the given gap
+def schedule(repertoire,today,gap) :
+    meta = repertoire.meta
+    if (not meta.load_balancing and meta.review_cap <= 0) :
+        return today + datetime.timedelta(days=gap)
+    start = today.toordinal()
+    # (without load balancing, only the gap itself is in the window)
+    window = 0
+    if (meta.load_balancing) :
+        window = int(round(gap * meta.balance_tolerance))
+    gaps = range(max(1,gap - window),gap + window + 1)
+    loads = {}
+    for candidate in gaps :
+        loads[candidate] = get_load(repertoire,start + candidate)
+    if (meta.review_cap > 0) :
+        gaps = [candidate for candidate in gaps if loads[candidate] < meta.review_cap]
+        # every day in the window is full: take the next one which isn't
+        candidate = gap + window + 1
+        while (not gaps) :
+            if (get_load(repertoire,start + candidate) < meta.review_cap) :
+                gaps = [candidate]
+                loads[candidate] = 0
+            candidate += 1
+    best = min(gaps, key = lambda candidate : (loads[candidate],abs(candidate - gap)))
+    return today + datetime.timedelta(days=best)
+
+# keeps at most `review_cap' of the due recalls among the training nodes (the
+# longest overdue), leaving the rest due for later sessions
+def cap_reviews(repertoire,nodes) :
+    meta = repertoire.meta
+    if (meta.review_cap <= 0) :
+        return nodes
+    reviews = [node for node in nodes if node.training.status == REVIEW]
+    if (len(reviews) <= meta.review_cap) :
+        return nodes
+    reviews.sort(key = lambda node : node.training.due_date)
+    dropped = set(reviews[meta.review_cap:])
+    return [node for node in nodes if node not in dropped]
+
 # handles the scheduling for the card based on user's performance
 # these are default settings - customisable parameters should be included
 # in the next version
 def handle_card_result(result,card,queue,repertoire) :
-    root = card[0]
-    node = card[1]
+    node = card.node
     status = node.training.status
     
     today = datetime.date.today()
-    tomorrow = today + datetime.timedelta(days=1)
     
     if (status == NEW) :
         print("Here")
         node.training.status = FIRST_STEP
         increase = int(round(3 * random.random()))
-        offset = min(1 + increase,len(queue))
-        queue.insert(offset,card)
+        queue.reinsert(card,1 + increase)
                     
     elif (status == FIRST_STEP) :
         if (result == "EASY") :
             node.training.status = REVIEW
             node.training.last_date = today
-            node.training.due_date = tomorrow
+            node.training.due_date = schedule(repertoire,today,first_gap)
             repertoire.meta.learning_data[1] += 1
         elif (result == "OK") :
             node.training.status = SECOND_STEP
             increase = int(round(3 * random.random()))
-            offset = min(6 + increase,len(queue))
-            queue.insert(offset,card)
+            queue.reinsert(card,6 + increase)
         elif (result == "HARD") :
             node.training.status = FIRST_STEP            
             increase = int(round(3 * random.random()))
-            offset = min(1 + increase,len(queue))
-            queue.insert(offset,card)
+            queue.reinsert(card,1 + increase)
 
     elif (status == SECOND_STEP) :
         if (result == "EASY") :
             node.training.status = REVIEW
             node.training.last_date = today
-            node.training.due_date = today + datetime.timedelta(days=3)
+            node.training.due_date = schedule(repertoire,today,easy_first_gap)
             repertoire.meta.learning_data[1] += 1
         elif (result == "OK") :
             node.training.status = REVIEW
             node.training.last_date = today
-            node.training.due_date = tomorrow
+            node.training.due_date = schedule(repertoire,today,first_gap)
             repertoire.meta.learning_data[1] += 1
         elif (result == "HARD") :
             node.training.status = FIRST_STEP            
             increase = int(round(3 * random.random()))
-            offset = min(1 + increase,len(queue))
-            queue.insert(offset,card)
+            queue.reinsert(card,1 + increase)
             
     elif (status == REVIEW) :
         previous_gap = (node.training.due_date - node.training.last_date).days
 
         if (result == "HARD") :
             node.training.status = FIRST_STEP
-            offset = min(2,len(queue))
-            queue.insert(offset,card)
+            queue.reinsert(card,2)
             repertoire.meta.learning_data[1] -= 1
 
         else :
             if (result == "EASY") :
-                multiplier = 3 + random.random()
+                multiplier = easy_multiplier + random.random()
             else :
-                multiplier = 2 + random.random()
+                multiplier = ok_multiplier + random.random()
             new_gap = int(round(previous_gap * multiplier))
             node.training.status = REVIEW
             node.training.last_date = today
-            node.training.due_date = today + datetime.timedelta(days=new_gap)
+            node.training.due_date = schedule(repertoire,today,new_gap)
 
-# builds the training queue from the repertoire tree
-def generate_training_queue(node,board) :
-    # the board must be returned as it was given
-    queue = []    
-    
-    if (node.training) :
-        status = node.training.status
-        due_date = node.training.due_date
-        today = datetime.date.today()
-        if (status == 0 or status == 1 or status == 2 or (status == 3 and due_date <= today)) :
-            # add a card to the queue
-            solution = board.pop()
-            problem = board.pop()
-            game = chess.pgn.Game()
-            game.setup(board)
-            new_node = game.add_variation(problem)
-            new_node = new_node.add_variation(solution)
-            board.push(problem)
-            board.push(solution)
-            queue.append([game,node])
-
-    # recursive part
-    if (not node.is_end()) :
-        if (node.player_to_move) :
-            # search only the main variation
-            child = node.variations[0]
-            board.push(child.move)
-            queue += generate_training_queue(child,board)
-            board.pop()
+    recount(node)
+    reindex_due(repertoire,node)
+    journal_result(repertoire,node)
 
-        else :
-            # search all variations
-            for child in node.variations :
-                board.push(child.move)
-                queue += generate_training_queue(child,board)
-                board.pop()
+# returns the training cards of the repertoire tree, in playing order
+def generate_training_queue(node) :
+    collector = CardCollector()
+    traverse(node,[collector])
+    return make_cards(node.game(),collector.nodes)
 
-    return queue
+# yields a card for each of the given solution nodes, setting up its
+# position only as the session asks for it
+def make_cards(repertoire,nodes) :
+    cache = repertoire.position_cache
+    for node in nodes :
+        yield Card(node,cache.board(node.parent))
 
-    
-############### 
+###################
+# instrumentation #
+###################
+
+# Setting the environment variable OT_PROFILE (or passing --profile) times the
+# trainer's hot paths for the session: the functions below are swapped for
+# timed wrappers, and a report of call counts and times is written to the
+# Profiles/ folder on exit. OT_PROFILE=cprofile (or --cprofile) also dumps a
+# cProfile trace next to the report. Nothing is wrapped when profiling is
+# off, so it then costs nothing.
+
+# path to the profile reports
+profile_path = "Profiles"
+
+# the functions to time
+profiled_functions = ["open_repertoire", "save_repertoire", "update", "normalise",
+                      "traverse", "get_counts", "make_cards", "play_card",
+                      "render_card", "render_board", "input"]
+
+# Timer - the calls and times (in seconds) of a profiled function
+class Timer :
+    def __init__(self) :
+        self.calls = 0
+        # (the depth of the calls is kept per thread, as the cards are
+        # rendered on a thread of their own)
+        self.nesting = threading.local()
+        self.times = array.array("d")
+
+    # returns the depth of the current thread's calls
+    def depth(self) :
+        return getattr(self.nesting, "depth", 0)
+
+    def enter(self) :
+        self.nesting.depth = self.depth() + 1
+
+    def leave(self) :
+        self.nesting.depth -= 1
+
+    def record(self, seconds) :
+        self.calls += 1
+        self.times.append(seconds)
+
+# the timers of the profiled functions, by name
+timers = {}
+
+# returns a timed wrapper for a function
+# only the outermost call of a recursive function is timed; a generator is
+# timed over all the items it yields, and recorded once it finishes
+def timed(function,timer,is_generator) :
+    def timed_generator(*args) :
+        items = function(*args)
+        elapsed = 0
+        try :
+            while (True) :
+                timer.enter()
+                start = time.perf_counter()
+                try :
+                    item = next(items)
+                except StopIteration :
+                    return
+                finally :
+                    elapsed += time.perf_counter() - start
+                    timer.leave()
+                yield item
+        finally :
+            timer.record(elapsed)
+
+    def wrapper(*args, **kwargs) :
+        if (timer.depth() > 0) :
+            return function(*args, **kwargs)
+        if (is_generator) :
+            return timed_generator(*args, **kwargs)
+        timer.enter()
+        start = time.perf_counter()
+        try :
+            return function(*args, **kwargs)
+        finally :
+            timer.record(time.perf_counter() - start)
+            timer.leave()
+
+    return wrapper
+
+# swaps the profiled functions for timed wrappers, and arranges for the
+# report to be written on exit
+def start_profiling(trace) :
+    import inspect
+    for name in profiled_functions :
+        timers[name] = Timer()
+        # (each is a module global, or a builtin)
+        function = globals().get(name, getattr(builtins, name, None))
+        globals()[name] = timed(function,timers[name],inspect.isgeneratorfunction(function))
+    profiler = None
+    if (trace) :
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    atexit.register(stop_profiling,profiler,time.strftime("%Y%m%d-%H%M%S"))
+
+# returns the given percentile of some (sorted) times
+def percentile(times,fraction) :
+    return times[int(round(fraction * (len(times) - 1)))]
+
+# writes the profile report (and the cProfile trace, if any)
+def stop_profiling(profiler,stamp) :
+    os.makedirs(profile_path, exist_ok = True)
+    report_path = os.path.join(profile_path, "session-" + stamp + ".txt")
+    with open(report_path, "w") as file :
+        file.write("FUNCTION".ljust(26) + "CALLS".rjust(8) + "TOTAL S".rjust(12)
+                   + "P50 MS".rjust(12) + "P95 MS".rjust(12) + "\n")
+        for name in profiled_functions :
+            timer = timers[name]
+            if (timer.calls == 0) :
+                continue
+            times = sorted(timer.times)
+            file.write(name.ljust(26) + str(timer.calls).rjust(8) + f"{sum(times):.3f}".rjust(12)
+                       + f"{percentile(times,0.5) * 1000:.3f}".rjust(12)
+                       + f"{percentile(times,0.95) * 1000:.3f}".rjust(12) + "\n")
+    print("Profile written to " + report_path)
+    if (profiler != None) :
+        profiler.disable()
+        trace_path = os.path.join(profile_path, "session-" + stamp + ".prof")
+        profiler.dump_stats(trace_path)
+        print("Trace written to " + trace_path)
+
+################
+# command line #
+################
+
+# Run without a command, the trainer opens the main menu. The commands work
+# on the repertoire folder without any prompts, for scripts and batch jobs;
+# each can be run over several folders (--dir, repeated).
+
+# returns the filenames of the named repertoires (all of them if none are
+# named), exiting with an error if any is missing
+def select_repertoires(names) :
+    filenames = list_repertoires()
+    if (len(names) == 0) :
+        return filenames
+    for name in names :
+        if (name + ".rpt" not in filenames) :
+            sys.exit(f"trainer: no repertoire `{name}' in {rep_path}")
+    return [name + ".rpt" for name in names]
+
+# prints the main menu's overview of the repertoires
+def stats_command(args) :
+    if (args.json) :
+        entries = get_stats_entries(list_repertoires())
+        print(json.dumps(entries, default = str, indent = 2))
+    else :
+        print_main_overview(list_repertoires())
+
+# prints the training waiting in each repertoire on a given date
+def due_command(args) :
+    date = args.date or datetime.date.today()
+    task = functools.partial(summarise_due,date,args.positions)
+    summaries = map_repertoires(task,select_repertoires(args.names))
+    if (args.json) :
+        print(json.dumps(summaries, indent = 2))
+        return
+    name_width = 20
+    print("NAME".ljust(name_width) + "NEW".ljust(6) + "LEARNING".ljust(10) + "DUE".ljust(6))
+    for summary in summaries :
+        counts = summary["counts"]
+        info = summary["name"].ljust(name_width)
+        info += str(counts[0]).ljust(6)
+        info += str(counts[1] + counts[2]).ljust(10)
+        info += str(summary["due"]).ljust(6)
+        print(info)
+        for fen, solution in summary.get("positions",[]) :
+            print("    " + fen + "    " + solution)
+
+# writes a repertoire as PGN (the repertoire tree is a game, its lines
+# the variations)
+def export_command(args) :
+    filename = select_repertoires([args.name])[0]
+    repertoire = open_repertoire(filename)
+    repertoire.journal.close()
+    repertoire.headers["Event"] = repertoire.meta.name
+    if (args.output != None) :
+        with open(args.output, "w") as file :
+            print(repertoire, file = file, end = "\n\n")
+    else :
+        print(repertoire, end = "\n\n")
+
+# brings the scheduling of repertoires up to date and saves them
+def normalise_command(args) :
+    if (len(args.names) == 0 and not args.all) :
+        sys.exit("trainer: name the repertoires to normalise, or give --all")
+    filenames = select_repertoires(args.names)
+    map_repertoires(normalise_file,filenames)
+    print(f"Normalised {len(filenames)} repertoires in {rep_path}.")
+
+# looks a position up across the repertoires
+def find_command(args) :
+    board = chess.Board()
+    text = " ".join(args.position)
+    if ("/" in text) :
+        try :
+            board = chess.Board(text)
+        except ValueError :
+            sys.exit(f"trainer: invalid FEN `{text}'")
+    else :
+        for move in args.position :
+            try :
+                board.push_san(move)
+            except ValueError :
+                sys.exit(f"trainer: illegal move `{move}' in {board.fen()}")
+    refresh_position_index()
+    found = find_position(board)
+    if (args.json) :
+        entries = []
+        for name, move, status in found :
+            entries.append({"name" : name, "move" : move.uci(), "san" : board.san(move), "status" : status_name(status)})
+        print(json.dumps(entries, indent = 2))
+        return
+    if (len(found) == 0) :
+        print("The position is in none of the repertoires.")
+        return
+    name_width = 20
+    print("NAME".ljust(name_width) + "SOLUTION".ljust(10) + "STATUS")
+    for name, move, status in found :
+        print(name.ljust(name_width) + board.san(move).ljust(10) + status_name(status))
+
+# converts the repertoires still in the pickled format (which opening them
+# would do anyway)
+def migrate_command(args) :
+    filenames = migrate_repertoires()
+    print(f"Migrated {len(filenames)} repertoires in {rep_path}.")
+
+def convert_command(args) :
+    if (use_database()) :
+        sys.exit(f"trainer: {rep_path} already keeps its repertoires in {database_name}")
+    filenames = convert_to_database()
+    print(f"Copied {len(filenames)} repertoires into {database_path()}.")
+
+commands = {
+    "stats" : stats_command,
+    "due" : due_command,
+    "export" : export_command,
+    "normalise" : normalise_command,
+    "migrate" : migrate_command,
+    "convert" : convert_command,
+    "find" : find_command,
+}
+
+def parse_arguments(arguments) :
+    parser = argparse.ArgumentParser(prog = "trainer.py", description = "Opening Trainer")
+    parser.add_argument("--dir", action = "append",
+                        help = f"repertoire folder (default: {rep_path}); may be repeated")
+    parser.add_argument("--profile", action = "store_true", help = "time the hot paths (see the manual)")
+    parser.add_argument("--cprofile", action = "store_true", help = "also write a cProfile trace")
+    subparsers = parser.add_subparsers(dest = "command")
+    stats_parser = subparsers.add_parser("stats", help = "print the repertoire overview")
+    stats_parser.add_argument("--json", action = "store_true")
+    due_parser = subparsers.add_parser("due", help = "print the training waiting in each repertoire")
+    due_parser.add_argument("names", nargs = "*", help = "repertoires (default: all)")
+    due_parser.add_argument("--date", type = datetime.date.fromisoformat, help = "count reviews due by this date (YYYY-MM-DD)")
+    due_parser.add_argument("--positions", action = "store_true", help = "list the due positions")
+    due_parser.add_argument("--json", action = "store_true")
+    export_parser = subparsers.add_parser("export", help = "write a repertoire as PGN")
+    export_parser.add_argument("name")
+    export_parser.add_argument("-o", "--output", help = "PGN file (default: standard output)")
+    normalise_parser = subparsers.add_parser("normalise", help = "bring the scheduling up to date")
+    normalise_parser.add_argument("names", nargs = "*")
+    normalise_parser.add_argument("--all", action = "store_true", help = "normalise every repertoire")
+    subparsers.add_parser("migrate", help = "convert pickled repertoires to the current file format")
+    subparsers.add_parser("convert", help = "copy the repertoire files into a SQLite database")
+    find_parser = subparsers.add_parser("find", help = "look a position up across the repertoires")
+    find_parser.add_argument("position", nargs = "+", help = "a FEN, or moves (SAN or UCI) from the starting position")
+    find_parser.add_argument("--json", action = "store_true")
+    return parser.parse_args(arguments)
+
+def main(arguments) :
+    args = parse_arguments(arguments)
+    profile = os.environ.get("OT_PROFILE", "")
+    if (profile != "" or args.profile or args.cprofile) :
+        start_profiling(profile == "cprofile" or args.cprofile)
+    if (args.command == None) :
+        if (args.dir != None) :
+            set_rep_path(args.dir[0])
+        run_on_screen(main_menu)
+        return
+    for path in args.dir or [rep_path] :
+        if (not os.path.isdir(path)) :
+            sys.exit(f"trainer: no such folder `{path}'")
+        set_rep_path(path)
+        if (args.dir != None and len(args.dir) > 1) :
+            print(f"== {path}")
+        commands[args.command](args)
+
+###############
 # entry point #
 ###############
 
-main_menu()
+if (__name__ == "__main__") :
+    main(sys.argv[1:])
 